@@ -1,13 +1,103 @@
+import os
+from collections import OrderedDict
+
+import numpy as np
 import pygame
 
+# In headless mode no image is ever loaded: the getters return None so that the game rules can run
+# without a display (batch simulations, CI). Set ROGUE_HEADLESS=1 before importing to enable it.
+headless = os.environ.get("ROGUE_HEADLESS", "0") != "0"
+
+size_factor = round(16 * 1.25)
+
+
+def set_headless(value=True):
+    global headless
+    headless = value
+
+
+# Every loaded image goes through this cache, keyed by (name, size) for the files and by (surface, size) for
+# the rescaled surfaces, so that each PNG is decoded and scaled once per process. The least recently used
+# entries are evicted when there are more than cache_max_size of them, None means no bound.
+cache_max_size = None
+_cache = OrderedDict()
+
+
+def _cached(key, load):
+    image = _cache.get(key)
+    if image is None:
+        image = load()
+        if pygame.display.get_surface() is not None:
+            image = image.convert_alpha()
+        _cache[key] = image
+        if cache_max_size is not None and len(_cache) > cache_max_size:
+            _cache.popitem(last=False)
+    else:
+        _cache.move_to_end(key)
+    return image
+
+
+def clear_cache():
+    """Forgets every loaded image and rendered text, so that they are converted when loaded again once the display
+        is created, see Game.play_with_graphics."""
+    _cache.clear()
+    _text_cache.clear()
+
+
+# The rendered texts of the interface, keyed by (font, text, colour), so that a text drawn again and again is
+# rasterized once. The least recently used ones are evicted when there are more than text_cache_max_size of them.
+text_cache_max_size = 256
+_text_cache = OrderedDict()
+
 
-def get_image(name):
-    dest = "Images/Elements/"
-    size_factor = round(16 * 1.25)
-    # print(dest+name)
-    image = pygame.image.load(dest + name)
+def render_text(font, text, colour=(0, 0, 0)):
+    """Returns font.render(text, True, colour), from the cache if this text was already rendered."""
+    key = (font, text, colour)
+    surface = _text_cache.get(key)
+    if surface is None:
+        surface = font.render(text, True, colour)
+        _text_cache[key] = surface
+        if len(_text_cache) > text_cache_max_size:
+            _text_cache.popitem(last=False)
+    else:
+        _text_cache.move_to_end(key)
+    return surface
 
-    return pygame.transform.scale(image, (size_factor, size_factor))
+
+def get_image(name, size=None):
+    """Returns the image Images/Elements/name scaled to a cell, then to size if given."""
+    if headless:
+        return None
+    if size is not None:
+        return _cached((name, size), lambda: pygame.transform.scale(get_image(name), size))
+    return _cached((name, None), lambda: pygame.transform.scale(pygame.image.load("Images/Elements/" + name),
+                                                                (size_factor, size_factor)))
+
+
+def scale_image(image, size):
+    """Scales a loaded image, images are None in headless mode."""
+    if image is None:
+        return None
+    if image.get_size() == size:
+        return image
+    return _cached((image, size), lambda: pygame.transform.scale(image, size))
+
+
+# The tables giving the surface of a tile from the cells around it, built on first use by _tile_table
+_tile_tables = {}
+
+
+def _tile_table(build, floor):
+    key = (build, floor.empty, floor.ground)
+    if key not in _tile_tables:
+        _tile_tables[key] = build(floor.empty, floor.ground)
+    return _tile_tables[key]
+
+
+def warm_up(floor):
+    """Loads the tile tables now rather than on the first draw of a floor. floor can be the Map class."""
+    for build in (_ground_cells, _empty_cells, _cells_empty_vertex):
+        _tile_table(build, floor)
 
 
 ground_cell_paths = ["Background/FloorTopLeft.png",
@@ -24,31 +114,30 @@ ground_cell_paths = ["Background/FloorTopLeft.png",
 
                      "Background/FloorCorridorVert.png",
                      "Background/FloorCorridorHoriz.png"]
-ground_cell_surfaces = [get_image(img_path) for img_path in ground_cell_paths]
 
 
-def cases_ground(key, floor):
-    e = floor.empty
-    g = floor.ground
-    ground_cells = {
-        (e, g, e, g): ground_cell_surfaces[0],
-        (e, g, g, g): ground_cell_surfaces[1],
-        (e, g, g, e): ground_cell_surfaces[2],
+def _ground_cells(e, g):
+    surfaces = [get_image(img_path) for img_path in ground_cell_paths]
+    return {
+        (e, g, e, g): surfaces[0],
+        (e, g, g, g): surfaces[1],
+        (e, g, g, e): surfaces[2],
 
-        (g, g, e, g): ground_cell_surfaces[3],
-        (g, g, g, g): ground_cell_surfaces[4],
-        (g, g, g, e): ground_cell_surfaces[5],
+        (g, g, e, g): surfaces[3],
+        (g, g, g, g): surfaces[4],
+        (g, g, g, e): surfaces[5],
 
-        (g, e, e, g): ground_cell_surfaces[6],
-        (g, e, g, g): ground_cell_surfaces[7],
-        (g, e, g, e): ground_cell_surfaces[8],
+        (g, e, e, g): surfaces[6],
+        (g, e, g, g): surfaces[7],
+        (g, e, g, e): surfaces[8],
 
-        (g, g, e, e): ground_cell_surfaces[9],
-        (e, e, g, g): ground_cell_surfaces[10]
+        (g, g, e, e): surfaces[9],
+        (e, e, g, g): surfaces[10]
     }
-    if key not in ground_cells:
-        return False
-    return ground_cells[key]
+
+
+def cases_ground(key, floor):
+    return _tile_table(_ground_cells, floor).get(key, False)
 
 
 empty_cells_paths = [
@@ -73,37 +162,36 @@ empty_cells_paths = [
     "Background/WallDoubleTop.png",
     "Background/WallDoubleTop.png"
 ]
-empty_cells_surfaces = [get_image(img_path) for img_path in empty_cells_paths]
 
 
-def cases_empty(key, floor):
-    e = floor.empty
-    g = floor.ground
-    empty_cells = {
-        (g, e, e, e): empty_cells_surfaces[0],
-        (e, g, e, e): empty_cells_surfaces[1],
-        (g, g, e, e): empty_cells_surfaces[2],
+def _empty_cells(e, g):
+    surfaces = [get_image(img_path) for img_path in empty_cells_paths]
+    return {
+        (g, e, e, e): surfaces[0],
+        (e, g, e, e): surfaces[1],
+        (g, g, e, e): surfaces[2],
 
-        (g, e, g, e): empty_cells_surfaces[3],
-        (g, e, e, g): empty_cells_surfaces[4],
+        (g, e, g, e): surfaces[3],
+        (g, e, e, g): surfaces[4],
 
-        (e, g, g, e): empty_cells_surfaces[5],
-        (e, g, e, g): empty_cells_surfaces[6],
+        (e, g, g, e): surfaces[5],
+        (e, g, e, g): surfaces[6],
 
-        (g, g, g, e): empty_cells_surfaces[7],
-        (g, g, e, g): empty_cells_surfaces[8],
+        (g, g, g, e): surfaces[7],
+        (g, g, e, g): surfaces[8],
 
-        (e, e, e, g): empty_cells_surfaces[9],
-        (e, e, g, e): empty_cells_surfaces[10],
-        (e, e, g, g): empty_cells_surfaces[11],
-        (g, e, g, g): empty_cells_surfaces[12],
+        (e, e, e, g): surfaces[9],
+        (e, e, g, e): surfaces[10],
+        (e, e, g, g): surfaces[11],
+        (g, e, g, g): surfaces[12],
 
-        (e, g, g, g): empty_cells_surfaces[13],
-        (g, g, g, g): empty_cells_surfaces[14]
+        (e, g, g, g): surfaces[13],
+        (g, g, g, g): surfaces[14]
     }
-    if key not in empty_cells:
-        return False
-    return empty_cells[key]
+
+
+def cases_empty(key, floor):
+    return _tile_table(_empty_cells, floor).get(key, False)
 
 
 empty_vertex_cells_paths = [
@@ -146,132 +234,118 @@ empty_vertex_cells_paths = [
 
 ]
 
-empty_vertex_cells_surfaces = [get_image(img_path) for img_path in empty_vertex_cells_paths]
-
 
-def cases_empty_vertex(key, floor):
-    e = floor.empty
-    g = floor.ground
-    cells_empty_vertex = {
-        0: empty_vertex_cells_surfaces[0],
-        (e, e, e, e): empty_vertex_cells_surfaces[1],
-
-        (e, e, e, g): empty_vertex_cells_surfaces[2],
-        (e, e, g, e): empty_vertex_cells_surfaces[3],
-        (e, g, e, e): empty_vertex_cells_surfaces[4],
-        (g, e, e, e): empty_vertex_cells_surfaces[5],
-
-        (g, e, g, e, e, g, g, g): empty_vertex_cells_surfaces[6],
-        (e, e, g, e, e, g, g, g): empty_vertex_cells_surfaces[7],
-        (g, e, e, e, e, g, g, g): empty_vertex_cells_surfaces[8],
-        (g, e, g, e, e, e, e, e): empty_vertex_cells_surfaces[9],
-
-        (g, e, g, g, e, g, e, g): empty_vertex_cells_surfaces[10],
-        (g, e, g, g, e, g, e, e): empty_vertex_cells_surfaces[11],
-        (g, e, e, g, e, g, e, g): empty_vertex_cells_surfaces[12],
-        (e, e, g, e, e, e, e, g): empty_vertex_cells_surfaces[13],
-
-        (g, e, g, e, g, g, e, g): empty_vertex_cells_surfaces[14],
-        (g, e, g, e, g, e, e, g): empty_vertex_cells_surfaces[15],
-        (e, e, g, e, g, g, e, g): empty_vertex_cells_surfaces[16],
-        (g, e, e, e, e, g, e, e): empty_vertex_cells_surfaces[17],
-
-        (g, g, g, e, e, g, e, g): empty_vertex_cells_surfaces[18],
-        (g, g, g, e, e, e, e, g): empty_vertex_cells_surfaces[19],
-        (g, g, g, e, e, g, e, e): empty_vertex_cells_surfaces[20],
-        (e, e, e, e, e, g, e, g): empty_vertex_cells_surfaces[21],
-
-        (g, e, g, e, e, g, e, g): empty_vertex_cells_surfaces[22],
-        (g, e, e, e, e, g, e, g): empty_vertex_cells_surfaces[23],
-        (e, e, g, e, e, g, e, g): empty_vertex_cells_surfaces[24],
-        (g, e, g, e, e, e, e, g): empty_vertex_cells_surfaces[25],
-        (g, e, g, e, e, g, e, e): empty_vertex_cells_surfaces[26],
-
-        (g, e, e, e, e, e, e, g): empty_vertex_cells_surfaces[27],
-        (e, e, g, e, e, g, e, e): empty_vertex_cells_surfaces[28]
+def _cells_empty_vertex(e, g):
+    surfaces = [get_image(img_path) for img_path in empty_vertex_cells_paths]
+    return {
+        0: surfaces[0],
+        (e, e, e, e): surfaces[1],
+
+        (e, e, e, g): surfaces[2],
+        (e, e, g, e): surfaces[3],
+        (e, g, e, e): surfaces[4],
+        (g, e, e, e): surfaces[5],
+
+        (g, e, g, e, e, g, g, g): surfaces[6],
+        (e, e, g, e, e, g, g, g): surfaces[7],
+        (g, e, e, e, e, g, g, g): surfaces[8],
+        (g, e, g, e, e, e, e, e): surfaces[9],
+
+        (g, e, g, g, e, g, e, g): surfaces[10],
+        (g, e, g, g, e, g, e, e): surfaces[11],
+        (g, e, e, g, e, g, e, g): surfaces[12],
+        (e, e, g, e, e, e, e, g): surfaces[13],
+
+        (g, e, g, e, g, g, e, g): surfaces[14],
+        (g, e, g, e, g, e, e, g): surfaces[15],
+        (e, e, g, e, g, g, e, g): surfaces[16],
+        (g, e, e, e, e, g, e, e): surfaces[17],
+
+        (g, g, g, e, e, g, e, g): surfaces[18],
+        (g, g, g, e, e, e, e, g): surfaces[19],
+        (g, g, g, e, e, g, e, e): surfaces[20],
+        (e, e, e, e, e, g, e, g): surfaces[21],
+
+        (g, e, g, e, e, g, e, g): surfaces[22],
+        (g, e, e, e, e, g, e, g): surfaces[23],
+        (e, e, g, e, e, g, e, g): surfaces[24],
+        (g, e, g, e, e, e, e, g): surfaces[25],
+        (g, e, g, e, e, g, e, e): surfaces[26],
+
+        (g, e, e, e, e, e, e, g): surfaces[27],
+        (e, e, g, e, e, g, e, e): surfaces[28]
     }
-    if key not in cells_empty_vertex:
-        return False
-
-    return cells_empty_vertex[key]
 
 
-def generate_graphic_map(floor):
-    m = floor._mat
-    e = floor.empty
-    g = floor.ground
-
-    if not floor.graphic_map:
-        for y in range(len(m) + 1):
-            floor.graphic_map.append([[None, False]] * (len(m) + 1))
+def cases_empty_vertex(key, floor):
+    return _tile_table(_cells_empty_vertex, floor).get(key, False)
 
-    for y in range(len(floor.graphic_map)):
-        for x in range(len(floor.graphic_map[y])):
 
-            try:
-                elem = floor.get_without_coord(x, y)
-            except IndexError:
-                elem = e
+def tile_codes(floor):
+    """Returns for each cell of the graphic map an integer describing the terrain around it :
+        bit 8 is set if the cell is ground, bits 7 to 0 if its neighbours are ground, in the order
+        up_left, up, up_right, left, right, down_left, down, down_right.
+        The graphic map has one more row and column than the map."""
+    size = len(floor)
+    padded = np.zeros((size + 3, size + 3), dtype=np.uint16)
+    padded[1:size + 1, 1:size + 1] = floor.ground_mask()
 
-            try:
-                up = floor.get_without_coord(x, y - 1)
-            except IndexError:
-                up = e
+    codes = padded[1:size + 2, 1:size + 2] << 8
+    neighbours = [(-1, -1), (0, -1), (1, -1), (-1, 0), (1, 0), (-1, 1), (0, 1), (1, 1)]
+    for bit, (dx, dy) in zip(range(7, -1, -1), neighbours):
+        codes |= padded[1 + dy:size + 2 + dy, 1 + dx:size + 2 + dx] << bit
+    return codes
 
-            try:
-                down = floor.get_without_coord(x, y + 1)
-            except IndexError:
-                down = e
 
-            try:
-                left = floor.get_without_coord(x - 1, y)
-            except IndexError:
-                left = e
+def tile_surface(code, floor):
+    """Returns the surface corresponding to a code of tile_codes"""
+    e = floor.empty
+    g = floor.ground
+    up_left, up, up_right, left, right, down_left, down, down_right = [g if code >> bit & 1 else e
+                                                                       for bit in range(7, -1, -1)]
+    if code >> 8:
+        return cases_ground((up, down, left, right), floor)
 
-            try:
-                right = floor.get_without_coord(x + 1, y)
-            except IndexError:
-                right = e
+    cells_around = (up_left, up, up_right, left, right, down_left, down, down_right)
 
-            if elem == g:
-                floor.graphic_map[y][x] = [cases_ground((up, down, left, right), floor), False]
+    if cases_empty_vertex(cells_around, floor):
+        return cases_empty_vertex(cells_around, floor)
 
-            else:
+    elif cases_empty((up, down, left, right), floor):
+        return cases_empty((up, down, left, right), floor)
 
-                try:
-                    up_left = floor.get_without_coord(x - 1, y - 1, )
-                except IndexError:
-                    up_left = e
+    elif cases_empty_vertex((up_left, up_right, down_right, down_left), floor):
+        return cases_empty_vertex((up_left, up_right, down_right, down_left), floor)
 
-                try:
-                    up_right = floor.get_without_coord(x + 1, y - 1)
-                except IndexError:
-                    up_right = e
+    return cases_empty_vertex(0, floor)
 
-                try:
-                    down_left = floor.get_without_coord(x - 1, y + 1)
-                except IndexError:
-                    down_left = e
 
-                try:
-                    down_right = floor.get_without_coord(x + 1, y + 1)
-                except IndexError:
-                    down_right = e
+def generate_graphic_map(floor):
+    codes = floor.tile_codes if floor.tile_codes is not None else tile_codes(floor)
+    surfaces = {code: tile_surface(code, floor) for code in np.unique(codes).tolist()}
 
-                cells_around = (up_left, up, up_right, left, right, down_left, down, down_right)
+    floor.graphic_map = [[surfaces[code] for code in row] for row in codes.tolist()]
 
-                if cases_empty_vertex(cells_around, floor):
-                    floor.graphic_map[y][x] = [cases_empty_vertex(cells_around, floor), False]
 
-                elif cases_empty((up, down, left, right), floor):
-                    floor.graphic_map[y][x] = [cases_empty((up, down, left, right), floor), False]
+def bake_floor(floor, fog):
+    """Generates the graphic map of a floor if needed then draws the whole terrain of a floor once on floor.terrain_surface,
+        and the fog covering the cells not revealed yet on floor.fog_surface."""
+    if not floor.graphic_map:
+        generate_graphic_map(floor)
+    n = len(floor.graphic_map)
+    floor.terrain_surface = pygame.Surface((n * size_factor, n * size_factor))
+    floor.fog_surface = pygame.Surface((n * size_factor, n * size_factor), pygame.SRCALPHA)
 
-                elif cases_empty_vertex((up_left, up_right, down_right, down_left), floor):
-                    floor.graphic_map[y][x] = [cases_empty_vertex((up_left, up_right, down_right, down_left), floor),
-                                               False]
+    for y, row in enumerate(floor.graphic_map):
+        for x, surface in enumerate(row):
+            if surface:
+                floor.terrain_surface.blit(surface, (x * size_factor, y * size_factor))
+            if not floor.explored[y, x]:
+                floor.fog_surface.blit(fog, (x * size_factor, y * size_factor))
 
-                else:
-                    floor.graphic_map[y][x] = [cases_empty_vertex(0, floor), False]
+    if pygame.display.get_surface() is not None:
+        floor.terrain_surface = floor.terrain_surface.convert()
+        floor.fog_surface = floor.fog_surface.convert_alpha()
 
 
 def get_hero_image(key):
@@ -284,14 +358,18 @@ def get_monster_image(key):
         return [get_image("Monsters/" + key + "-" + str(i) + ".png") for i in range(2)]
 
 
-def get_item_image(key):
-    return get_image("Items/" + key + ".png")
+def get_item_image(key, size=None):
+    return get_image("Items/" + key + ".png", size)
 
 
 def get_room_object_image(key):
-    dest = "Images/Elements/RoomObjects/"
-    size_factor = round(16 * 1.25)
-    image = pygame.image.load(dest + key + ".png")
-    x = image.get_width() * size_factor / 16
-    y = image.get_height() * size_factor / 16
-    return pygame.transform.scale(image, (int(x), int(y)))
+    if headless:
+        return None
+
+    def load():
+        image = pygame.image.load("Images/Elements/RoomObjects/" + key + ".png")
+        x = image.get_width() * size_factor / 16
+        y = image.get_height() * size_factor / 16
+        return pygame.transform.scale(image, (int(x), int(y)))
+
+    return _cached(("RoomObjects/" + key + ".png", None), load)
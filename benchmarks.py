@@ -0,0 +1,251 @@
+"""Micro benchmarks of the game hot paths : map generation, monster AI and turn resolution.
+
+    python benchmarks.py            runs the benchmarks and compares them with the stored baseline
+    python benchmarks.py --save     runs the benchmarks and stores the results as the new baseline
+    python benchmarks.py -k fog     only runs the benchmarks whose name contains "fog"
+
+The exit code is 1 when a benchmark is more than REGRESSION_FACTOR times slower than its baseline,
+or when the corridors of a generated map do not link all its rooms.
+"""
+import argparse
+import json
+import os
+import random
+import statistics
+import sys
+import time
+
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+
+import CasesGraphiques as CG
+import main
+
+BASELINE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmarks_baseline.json")
+REGRESSION_FACTOR = 1.8  # Above the noise: the medians of identical runs differ by up to 1.7 times on a busy machine
+SEED = 1234
+SAMPLES_PER_STATE = 5
+ROUNDS = 4  # The samples of a benchmark are taken in this many rounds over the suite, see run_benchmarks
+
+MAP_SIZES = [20, 40, 80]
+MONSTER_COUNTS = [5, 20, 80]
+ROOM_PLACEMENT_SIZES = [50, 100, 250, 500]  # The time of the room placement should grow like the area of the map
+ROOM_DENSITY = 0.3
+
+_benchmarks = []
+rng = random.Random(SEED)  # Every random draw of the benchmarks, seeded again before each run of them
+
+
+def benchmark(name, params, samples_per_state=SAMPLES_PER_STATE):
+    """Registers a benchmark. The decorated function gets the params and returns (setup, run) :
+        setup() builds a fresh state which is not timed, run(state) is the timed part.
+        samples_per_state is 1 when run uses up its state."""
+
+    def register(function):
+        for p in params:
+            _benchmarks.append((name, p, function, samples_per_state))
+        return function
+
+    return register
+
+
+def new_map(size, nb_monsters):
+    """A map of the given size, being the current floor of the game, with nb_monsters extra monsters.
+        The effects of the previous benchmarks are cleared."""
+    game = main.the_game()
+    game.hero.hp = 10 ** 6
+    game.effects = main.EffectScheduler()
+    floor = main.Map(size=size, hero=game.hero, floor_number=0, rng=random.Random(rng.getrandbits(32)))
+    game.floor = game.gv.floor = floor
+    game.floor_list = [floor]
+
+    cells = [main.Coord(x, y) for y in range(size) for x in range(size)]
+    rng.shuffle(cells)
+    for c in cells:
+        if nb_monsters <= 0:
+            break
+        if floor.get(c) == main.Map.ground:
+            floor.put(c, game.rand_monster(floor.floor_number))
+            nb_monsters -= 1
+    return floor
+
+
+@benchmark("Map.__init__", [(size, 0) for size in MAP_SIZES])
+def bench_map_init(size, nb_monsters):
+    hero = main.the_game().hero
+    return lambda: None, lambda state: main.Map(size=size, hero=hero, floor_number=0,
+                                                rng=random.Random(rng.getrandbits(32)))
+
+
+def empty_map(size):
+    """A map of the given size without any room."""
+    floor = main.Map.__new__(main.Map)
+    floor._setup(size, main.the_game().hero, 0, None, random.Random(rng.getrandbits(32)))
+    return floor
+
+
+def map_with_rooms(size):
+    """A map of the given size with rooms covering ROOM_DENSITY of it, not reached by corridors yet."""
+    floor = empty_map(size)
+    floor.generate_rooms(density=ROOM_DENSITY)
+    return floor
+
+
+@benchmark("Map.generate_rooms", [(size, 0) for size in ROOM_PLACEMENT_SIZES], samples_per_state=1)
+def bench_generate_rooms(size, nb_monsters):
+    """About 1900 rooms for the largest map."""
+    return lambda: empty_map(size), lambda floor: floor.generate_rooms(density=ROOM_DENSITY)
+
+
+@benchmark("Map.reach_all_rooms", [(size, 0) for size in ROOM_PLACEMENT_SIZES], samples_per_state=1)
+def bench_reach_all_rooms(size, nb_monsters):
+    return lambda: map_with_rooms(size), lambda floor: floor.reach_all_rooms()
+
+
+def unconnected_maps():
+    """Returns the sizes of ROOM_PLACEMENT_SIZES for which a generated map has rooms which can't be walked to."""
+    res = []
+    for size in ROOM_PLACEMENT_SIZES:
+        floor = map_with_rooms(size)
+        floor.reach_all_rooms()
+        if not floor.rooms_connected():
+            res.append(size)
+    return res
+
+
+@benchmark("Map.move_all_monsters", [(size, n) for size in MAP_SIZES for n in MONSTER_COUNTS])
+def bench_move_all_monsters(size, nb_monsters):
+    return lambda: new_map(size, nb_monsters), lambda floor: floor.move_all_monsters()
+
+
+@benchmark("Map.update_elements", [(size, n) for size in MAP_SIZES for n in MONSTER_COUNTS])
+def bench_update_elements(size, nb_monsters):
+    return lambda: new_map(size, nb_monsters), lambda floor: floor.update_elements(0)
+
+
+@benchmark("CG.generate_graphic_map", [(size, 0) for size in MAP_SIZES])
+def bench_generate_graphic_map(size, nb_monsters):
+    """The tile tables are loaded beforehand, like when the game starts."""
+
+    def setup():
+        CG.warm_up(main.Map)
+        return new_map(size, nb_monsters)
+
+    return setup, CG.generate_graphic_map
+
+
+@benchmark("GraphicVariables.update_fog", [(size, 0) for size in MAP_SIZES])
+def bench_update_fog(size, nb_monsters):
+    """The fog is removed on every sample, as if the hero had moved since the previous one."""
+
+    def run(floor):
+        floor.fog_sources = None
+        main.the_game().gv.update_fog(floor)
+
+    return lambda: new_map(size, nb_monsters), run
+
+
+@benchmark("Game.apply_effects", [(20, n) for n in [20, 200, 1000]])
+def bench_apply_effects(size, nb_monsters):
+    """Every monster is poisoned (without losing hp) and weakened for the whole run."""
+
+    def setup():
+        floor = new_map(size, 0)
+        game = main.the_game()
+        for i in range(nb_monsters):
+            monster = game.rand_monster(floor.floor_number)
+            main.PoisonEffect(monster, 10 ** 6, 0).activate()
+            main.WeaknessEffect(monster, 10 ** 6).activate()
+        game.pop_messages()
+        return game
+
+    def run(game):
+        game.apply_effects()
+        game.pop_messages()
+
+    return setup, run
+
+
+@benchmark("Game.play_turn", [(size, n) for size in MAP_SIZES for n in MONSTER_COUNTS])
+def bench_turn(size, nb_monsters):
+    ways = list(main.Map.dir.values())
+
+    def run(floor):
+        main.the_game().play_turn(rng.choice(ways))
+        main.the_game().pop_messages()
+
+    return lambda: new_map(size, nb_monsters), run
+
+
+def measure(setup, run, repeat, samples_per_state=SAMPLES_PER_STATE):
+    """Returns the times of run in seconds of repeat samples.
+        A fresh state is built every samples_per_state samples."""
+    times = []
+    state = None
+    for i in range(repeat):
+        if i % samples_per_state == 0:
+            state = setup()
+        start = time.perf_counter()
+        run(state)
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def key(name, params):
+    return f"{name}[size={params[0]},monsters={params[1]}]"
+
+
+def run_benchmarks(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--save", action="store_true", help="store the results as the new baseline")
+    parser.add_argument("-k", default="", help="only run the benchmarks whose name contains this string")
+    parser.add_argument("--repeat", type=int, default=40, help="number of samples per benchmark, over all the rounds")
+    args = parser.parse_args(argv)
+
+    rng.seed(SEED)
+    main.the_game(main.Game(seed=SEED))
+
+    baseline = {}
+    if os.path.exists(BASELINE_FILE):
+        with open(BASELINE_FILE) as f:
+            baseline = json.load(f)
+
+    # The samples are taken in ROUNDS rounds over all the benchmarks, rather than all at once, so that a slow
+    # stretch of the machine spoils a few samples of every benchmark instead of all the samples of one
+    selected = [(key(name, params), function(*params), samples_per_state)
+                for name, params, function, samples_per_state in _benchmarks if args.k in key(name, params)]
+    times = {k: [] for k, _, _ in selected}
+    for _ in range(ROUNDS):
+        for k, (setup, run), samples_per_state in selected:
+            times[k] += measure(setup, run, -(-args.repeat // ROUNDS), samples_per_state)
+
+    results = {}
+    regressions = []
+    print(f"{'benchmark':<60} {'median (ms)':>12} {'baseline':>12} {'ratio':>8}")
+    for k, _, _ in selected:
+        results[k] = statistics.median(times[k])
+
+        line = f"{k:<60} {results[k] * 1000:>12.3f}"
+        if k in baseline:
+            ratio = results[k] / baseline[k]
+            line += f" {baseline[k] * 1000:>12.3f} {ratio:>8.2f}"
+            if ratio > REGRESSION_FACTOR:
+                line += "  <-- REGRESSION"
+                regressions.append(k)
+        print(line)
+
+    if args.save:
+        baseline.update(results)
+        with open(BASELINE_FILE, "w") as f:
+            json.dump(baseline, f, indent=4, sort_keys=True)
+        print(f"Baseline saved in {BASELINE_FILE}")
+        return 0
+
+    unconnected = unconnected_maps()
+    if unconnected:
+        print(f"Rooms can't be reached on the maps of size {unconnected}")
+    return 1 if regressions or unconnected else 0
+
+
+if __name__ == '__main__':
+    sys.exit(run_benchmarks())
@@ -1,12 +1,23 @@
 import copy
+import csv
+import heapq
+import json
 import math
+import multiprocessing
+import os
 import random
+import struct
+import sys
+import time
+from collections import deque
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 import CasesGraphiques as CG
+import numpy as np
 import pygame
 
 
-# random.seed(234789)
-
 def _find_getch():
     """Single char input, only works only on mac/linux/windows OS terminals"""
     try:
@@ -49,7 +60,9 @@ def clear_list(list_to_clear: list) -> None:
 
 
 class Coord(object):
-    """Implementation of a map coordinate"""
+    """Implementation of a map coordinate. Coordinates are used as keys, never change them once built."""
+
+    __slots__ = ('x', 'y')
 
     def __init__(self, x: int, y: int) -> None:
         """
@@ -60,9 +73,17 @@ class Coord(object):
         self.x = x
         self.y = y
 
+    def __reduce__(self) -> tuple:
+        return Coord, (self.x, self.y)
+
     def __eq__(self, other: "Coord") -> bool:
+        if not isinstance(other, Coord):
+            return NotImplemented
         return self.x == other.x and self.y == other.y
 
+    def __hash__(self) -> int:
+        return hash((self.x, self.y))
+
     def __repr__(self) -> str:
         return f"<{str(self.x)},{str(self.y)}>"
 
@@ -74,27 +95,28 @@ class Coord(object):
 
     def distance(self, other: "Coord") -> float:
         """Returns the distance between two coordinates."""
-        d = self - other
-        return math.sqrt(d.x * d.x + d.y * d.y)
+        return math.sqrt(self.square_distance(other))
+
+    def square_distance(self, other: "Coord") -> int:
+        """Returns the squared distance between two coordinates, to compare distances without sqrt."""
+        dx = self.x - other.x
+        dy = self.y - other.y
+        return dx * dx + dy * dy
 
     def empty_around(self, actual_map: "Map") -> bool:
         # Return True if the coordinates around are corresponding
-        res = True
-        for y in range(-1, 2):
-            for x in range(-1, 2):
-                res = res and (actual_map.get(self + Coord(x, y)) == Map.ground or actual_map.get(
-                    self + Coord(x, y)) == actual_map.hero)
-        return res
+        for way in Map.around:
+            cell = actual_map.get_xy(self.x + way.x, self.y + way.y)
+            if cell != Map.ground and cell != actual_map.hero:
+                return False
+        return True
 
     def get_empty_coord_around(self, actual_map: "Map") -> "Coord":
         available_coord_list = []
-        o = actual_map.get(self)
-        for i in range(-1, 2):
-            for j in range(-1, 2):
-                way = Coord(i, j)
-                if actual_map.check_move(o, way) == Map.ground:
-                    available_coord_list.append(self + way)
-        return random.choice(available_coord_list)
+        for way in Map.around:
+            if actual_map.get_xy(self.x + way.x, self.y + way.y) == Map.ground:
+                available_coord_list.append(self + way)
+        return actual_map.rng.choice(available_coord_list)
 
     def get_tuple(self) -> tuple:
         return self.x, self.y
@@ -109,6 +131,7 @@ class Element(object):
         if abbreviation == "":
             abbreviation = name[0]
         self.abbreviation = abbreviation
+        self.proto_ref = None  # (table, key, index) for the elements of the tables of Game and their copies
 
         self.graphicOutput = None
 
@@ -155,7 +178,7 @@ class RoomObject(Element):
             g.floor.rm(g.floor.pos(g.hero))
 
             g.actual_floor += 1
-            g.floor = g.gv.floor = g.floor_list[g.actual_floor]
+            g.floor = g.gv.floor = g.get_floor(g.actual_floor)
             g.add_message('You are now in stage ' + str(g.actual_floor + 1) + '/' + str(len(g.floor_list)))
 
             stair_coord = g.floor.pos(g._room_objects['downstair'])
@@ -174,7 +197,7 @@ class RoomObject(Element):
             g.floor.rm(g.floor.pos(g.hero))
 
             g.actual_floor -= 1
-            g.floor = g.gv.floor = g.floor_list[g.actual_floor]
+            g.floor = g.gv.floor = g.get_floor(g.actual_floor)
             g.add_message('You are now in stage ' + str(g.actual_floor + 1) + '/' + str(len(g.floor_list)))
 
             stair_coord = g.floor.pos(g._room_objects['upstair'])
@@ -191,9 +214,11 @@ class RoomObject(Element):
         list_of_items_sold = []
         for i in range(2):
             list_of_items_sold.append(
-                the_game().rand_element(Game.equipments, the_game().floor_list[the_game().actual_floor].floor_number))
+                the_game().rand_element(Game.equipments, the_game().floor_list[the_game().actual_floor].floor_number,
+                                        the_game().rng('loot')))
         list_of_items_sold.append(
-            the_game().rand_element(Game.weapons, the_game().floor_list[the_game().actual_floor].floor_number))
+            the_game().rand_element(Game.weapons, the_game().floor_list[the_game().actual_floor].floor_number,
+                                    the_game().rng('loot')))
 
         the_game().gv.draw_trader(list_of_items_sold)
 
@@ -325,22 +350,24 @@ class Hero(Creature):
         self.gold = gold
         self.stomach = stomach
         self.default_stomach_size = stomach
+        self.stomach_cool_down = None  # Turns before the next hp lost once the stomach is empty
 
         # GRAPHICS
-        images = CG.get_hero_image("Template")
+        self.costume = "Template"
+        images = CG.get_hero_image(self.costume)
 
         self.graphicOutput = images[0]
-        self.animationUDLR = {(0, -1): images[12:16],  # cannot put Coord since it's not hashable
+        self.animationUDLR = {Coord(0, -1): images[12:16],
 
-                              (0, 1): images[:4],
-                              (-1, 1): images[:4],
-                              (1, 1): images[:4],
+                              Coord(0, 1): images[:4],
+                              Coord(-1, 1): images[:4],
+                              Coord(1, 1): images[:4],
 
-                              (-1, 0): images[4:8],
-                              (-1, -1): images[4:8],
+                              Coord(-1, 0): images[4:8],
+                              Coord(-1, -1): images[4:8],
 
-                              (1, 0): images[8:12],
-                              (1, -1): images[8:12],
+                              Coord(1, 0): images[8:12],
+                              Coord(1, -1): images[8:12],
 
                               }
 
@@ -370,7 +397,7 @@ class Hero(Creature):
                     res += '> ' + e + ' : ' + str(self.__dict__[e]) + '\n'
         res += '> INVENTORY : ' + str([x.name for x in self._inventory]) + '\n'
         res += '> Effects : ' + str(
-            [f"{x.name}<{x.level}>({x.duration})" for x in the_game().active_effects if x.creature is self])
+            [f"{x.name}<{x.level}>({x.duration})" for x in the_game().effects.of(self)])
 
         if self.has_weapon():
             res += '> Weapon : ' + str(self.current_weapon().name)
@@ -461,15 +488,15 @@ class Hero(Creature):
     def check_stomach(self):
         cool_down_value = 5
         if self.stomach == 0:
-            if not hasattr(Hero.check_stomach, "cool_down"):
-                setattr(Hero.check_stomach, "cool_down", cool_down_value)
+            if self.stomach_cool_down is None:
+                self.stomach_cool_down = cool_down_value
             else:
-                if Hero.check_stomach.cool_down == 0:
+                if self.stomach_cool_down == 0:
                     self.hp -= 1
-                    Hero.check_stomach.cool_down = cool_down_value - 1
+                    self.stomach_cool_down = cool_down_value - 1
                     the_game().add_message("WARNING : No more food !")
                 else:
-                    Hero.check_stomach.cool_down -= 1
+                    self.stomach_cool_down -= 1
 
     def buy(self, o):
         if isinstance(o, Equipment):
@@ -483,6 +510,9 @@ class Hero(Creature):
 
     @staticmethod
     def choose_direction():
+        if the_game().replay_input is not None:
+            return Map.dir[the_game().replay_input.popleft()[1:]]
+
         the_game().add_message("Choose a direction to orientate yourself using the keys to move")
         the_game().gv.draw_message(200)
         pygame.display.update()
@@ -529,6 +559,7 @@ class Hero(Creature):
 
                     if choice is not None:
                         the_game().gv.inventory_on = False
+                        the_game().record("/" + choice)
                         return Map.dir[choice]
 
     def throw_item(self, item, distance):
@@ -626,7 +657,77 @@ class Hero(Creature):
                 raise NotImplementedError("Error might be due to an object not being managed.")
 
 
+class EffectScheduler(object):
+    """The active effects of a game, in the order they were activated. The ephemeral effects act on every round
+        while the constant ones are only woken up when they expire, their expiry rounds being kept in a heap.
+        The effects of each creature are indexed, so that finding or clearing them does not go through all of them."""
+
+    def __init__(self):
+        self.round = 0  # Rounds played, the expiry of the constant effects is counted in them
+        self._effects = {}  # The dicts are used as ordered sets
+        self._ephemeral = {}
+        self._by_creature = {}
+        self._expiries = []  # Heap of (round, push number, effect), the outdated entries are skipped when popped
+        self._pushes = 0
+
+    def __iter__(self):
+        return iter(list(self._effects))
+
+    def __len__(self):
+        return len(self._effects)
+
+    def __contains__(self, effect):
+        return effect in self._effects
+
+    def add(self, effect):
+        if effect in self._effects:
+            return
+        self._effects[effect] = None
+        self._by_creature.setdefault(effect.creature, {})[effect] = None
+        if isinstance(effect, EphemeralEffect):
+            self._ephemeral[effect] = None
+        else:
+            self.schedule(effect)
+
+    def schedule(self, effect):
+        """Wakes up an active constant effect when it expires, called again when its duration changes."""
+        if effect in self._effects and effect.expiry is not None:
+            heapq.heappush(self._expiries, (effect.expiry, self._pushes, effect))
+            self._pushes += 1
+
+    def remove(self, effect):
+        if effect not in self._effects:
+            return
+        del self._effects[effect]
+        self._ephemeral.pop(effect, None)
+        effects = self._by_creature[effect.creature]
+        del effects[effect]
+        if not effects:
+            del self._by_creature[effect.creature]
+
+    def of(self, creature):
+        """Returns the active effects of a creature."""
+        return list(self._by_creature.get(creature, ()))
+
+    def clear(self, creature):
+        for effect in self.of(creature):
+            self.remove(effect)
+
+    def tick(self):
+        """Plays a round: the ephemeral effects act, then the constant effects which are over are deactivated."""
+        self.round += 1
+        for effect in list(self._ephemeral):
+            if effect in self._ephemeral:  # An effect can remove another one, e.g. by killing its creature
+                effect.update()
+
+        while self._expiries and self._expiries[0][0] <= self.round:
+            expiry, _, effect = heapq.heappop(self._expiries)
+            if effect in self._effects and effect.expiry == expiry:
+                effect.deactivate()
+
+
 class Effect(object):
+    _icons = {}  # The icon of each effect class, loaded on first use
 
     def __init__(self, creature):
         self.game = the_game()
@@ -636,15 +737,14 @@ class Effect(object):
         self.duration = None
         self.level = 0
 
-        image = CG.get_image('Effects/' + self.name + '.png')  # change
-        self.graphicOutput = pygame.transform.scale(image, (32, 32))
+    @property
+    def graphicOutput(self):
+        if type(self) not in Effect._icons:
+            Effect._icons[type(self)] = CG.get_image('Effects/' + self.name + '.png', (32, 32))
+        return Effect._icons[type(self)]
 
     def delete(self):
-        try:
-            self.game.active_effects.remove(self)
-            del self
-        except ValueError:
-            pass
+        self.game.effects.remove(self)
 
     def update(self):
         if isinstance(self, EphemeralEffect):
@@ -661,11 +761,11 @@ class Effect(object):
         self.game.add_message(self.info)
 
     def add_effect(self):
-        self.game.active_effects.append(self)
+        self.game.effects.add(self)
 
     def activate(self) -> None:
         self.action()
-        if self not in self.game.active_effects:
+        if self not in self.game.effects:
             self.add_effect()
 
     def deactivate(self):
@@ -674,14 +774,7 @@ class Effect(object):
 
     @staticmethod
     def clear(unique=True):
-        effects_to_delete = []
-        for effect in the_game().active_effects:
-            if effect.creature is the_game().hero:
-                effects_to_delete.append(effect)
-
-        for effect in effects_to_delete:
-            Effect.delete(effect)
-
+        the_game().effects.clear(the_game().hero)
         return unique
 
 
@@ -805,11 +898,12 @@ class TeleportEffect(EphemeralEffect):  # IS AN INSTANT EFFECT
 
     def action(self):
         """Teleport the creature"""
-        r = the_game().floor.rand_room()
-        c = r.rand_coord()
+        rng = the_game().rng('combat')
+        r = the_game().floor.rand_room(rng)
+        c = r.rand_coord(rng)
 
         while not the_game().floor.get(c) == Map.ground:
-            c = r.rand_coord()
+            c = r.rand_coord(rng)
         the_game().floor.rm(the_game().floor.pos(self.creature))
         the_game().floor.put(c, self.creature)
 
@@ -824,6 +918,18 @@ class ConstantEffect(Effect):
         super().__init__(creature)
         self.has_been_activated = False
 
+    @property
+    def duration(self):
+        """Rounds left, counted from the round the effect expires at rather than updated on every round."""
+        if self.expiry is None:
+            return None
+        return self.expiry - self.game.effects.round
+
+    @duration.setter
+    def duration(self, value):
+        self.expiry = None if value is None else self.game.effects.round + value
+        self.game.effects.schedule(self)
+
     def activate(self, unique=True):
         if not self.has_been_activated:
             super().activate()
@@ -909,8 +1015,7 @@ class Equipment(Element):
         self.come_back = False
 
         # GRAPHICS
-        image = CG.get_item_image(self.name)
-        self.graphicOutput = [pygame.transform.scale(image, (16, 16)), pygame.transform.scale(image, (32, 32))]
+        self.graphicOutput = [CG.get_item_image(self.name, (16, 16)), CG.get_item_image(self.name, (32, 32))]
 
     def meet(self, hero):
         """Makes the hero meet an element. The hero takes the element."""
@@ -939,10 +1044,17 @@ class Weapon(Equipment):
 
     def __init__(self, name, abbreviation="", price=1, damage=1, launching_damage=1, come_back=False):
         Equipment.__init__(self, name, abbreviation, price)
-        self.damage = damage
+        self.damage = damage  # The damages can be (min, max) ranges, rolled for each copy by roll
         self.launching_damage = launching_damage
         self.come_back = come_back  # The weapon can come back to the hero when used (like a boomerang)
 
+    def roll(self, rng):
+        """Draws the damages of the weapon in their ranges."""
+        if isinstance(self.damage, tuple):
+            self.damage = rng.randint(*self.damage)
+        if isinstance(self.launching_damage, tuple):
+            self.launching_damage = rng.randint(*self.launching_damage)
+
 
 class Room(object):
     """A rectangular room in the map"""
@@ -960,25 +1072,22 @@ class Room(object):
     def __contains__(self, coord):
         return self.c1.x <= coord.x <= self.c2.x and self.c1.y <= coord.y <= self.c2.y
 
-    def intersect(self, other):
-        """Test if the room has an intersection with another room"""
-        sc3 = Coord(self.c2.x, self.c1.y)
-        sc4 = Coord(self.c1.x, self.c2.y)
-        return self.c1 in other or self.c2 in other or sc3 in other or sc4 in other or other.c1 in self
+    def area(self):
+        return (self.c2.x - self.c1.x + 1) * (self.c2.y - self.c1.y + 1)
 
     def center(self):
         """Returns the coordinates of the room center"""
         return Coord((self.c1.x + self.c2.x) // 2, (self.c1.y + self.c2.y) // 2)
 
-    def rand_coord(self):
+    def rand_coord(self, rng):
         """A random coordinate inside the room"""
-        return Coord(random.randint(self.c1.x, self.c2.x), random.randint(self.c1.y, self.c2.y))
+        return Coord(rng.randint(self.c1.x, self.c2.x), rng.randint(self.c1.y, self.c2.y))
 
     def rand_empty_coord(self, map):
         """A random coordinate inside the room which is free on the map."""
-        c = self.rand_coord()
+        c = self.rand_coord(map.rng)
         while map.get(c) != Map.ground or c == self.center():
-            c = self.rand_coord()
+            c = self.rand_coord(map.rng)
         return c
 
     def rand_empty_middle_coord(self, map):
@@ -990,16 +1099,16 @@ class Room(object):
                 if c.empty_around(map) and c != self.center():
                     list_of_coord_available.append(c)
         if len(list_of_coord_available) == 0:
-            return self.rand_coord()
+            return self.rand_coord(map.rng)
         else:
-            return random.choice(list_of_coord_available)
+            return map.rng.choice(list_of_coord_available)
 
     def decorate(self, map):
         """Decorates the room by adding a random equipment and monster."""
         for elem in self.specialObjects:
             map.put(self.rand_empty_middle_coord(map), elem)
-        map.put(self.rand_empty_coord(map), the_game().rand_equipment(map.floor_number))
-        map.put(self.rand_empty_coord(map), the_game().rand_monster(map.floor_number))
+        map.put(self.rand_empty_coord(map), Game.rand_element(Game.equipments, map.floor_number, map.rng))
+        map.put(self.rand_empty_coord(map), Game.rand_element(Game.monsters, map.floor_number, map.rng))
 
 
 class Map(object):
@@ -1017,144 +1126,366 @@ class Map(object):
            'w': Coord(-1, 1),
            'c': Coord(1, 1),
            }
+    around = [Coord(x, y) for x in range(-1, 2) for y in range(-1, 2)]  # The 9 ways, staying in place included
 
     empty = e = ' '  # A non walkable cell
     sizeFactor = round(16 * 1.25)
 
-    def __init__(self, size=20, hero=None, put_hero=True, floor_number=None, special_room=None):
-        self._mat = []
+    # Terrain codes of the tile grid
+    EMPTY_TILE = 0
+    GROUND_TILE = 1
+    _tiles = (empty, ground)
+
+    bucket_size = 8  # Side of the squares of the creatures spatial index
+    aggro_radius = 6  # Monsters closer than this to the hero move towards it, see move_all_monsters
+    flow_depth = 2 * aggro_radius  # Walking distance beyond which monsters take a greedy step instead of the flow
+
+    # Room placement, see generate_rooms
+    room_extents = (3, 8)  # Bounds of c2 - c1 for the random rooms
+    placement_tries = 50  # Rooms which do not fit in a row before the placement gives up
+    loop_ratio = 0.1  # Extra corridors making loops, per room, see reach_all_rooms
+    _disks = {}  # Radius -> mask of the disk, see Map.disk
+
+    def __init__(self, size=20, hero=None, put_hero=True, floor_number=None, special_room=None, nb_floors=None,
+                 rng=None, nb_rooms=4, room_density=None):
+        if rng is None:
+            rng = random.Random()
+        self._setup(size, hero, floor_number, special_room, rng)
+        self.generate_rooms(nb_rooms, room_density)
+        self.reach_all_rooms()
+
+        if nb_floors is None:
+            nb_floors = the_game().nb_floors
+        self.put_room_objects(nb_floors)
+        if put_hero:
+            self.put(self._rooms[0].center(), self.hero)
+        for r in self._rooms:
+            r.decorate(self)
+
+        if not CG.headless:
+            self.update_elements(0)
+
+    def _setup(self, size, hero, floor_number, special_room, rng):
+        """Initialises an empty map."""
+        self.rng = rng  # Random generator of the floor, generation included
+        self._size = size
+        self._terrain = np.full((size, size), Map.EMPTY_TILE, dtype=np.uint8)
+        self._entity_ids = np.zeros((size, size), dtype=np.int32)  # 0 when there is no element on the cell
+        self._entities = {}
+        self._next_entity_id = 1
         self._elem = {}
+        self.boss = None  # Copy of the boss put on the map, see Game.boss_ref
+        self._creature_buckets = {}  # (x // bucket_size, y // bucket_size) -> creatures of the square
+        self._walkable = None  # Ground mask with a border, flattened, computed again when the terrain changes
+        self._flow = None  # Index on the flattened bordered grid -> distance to the hero, shared by all monsters
+        self._flow_origin = None
+        self._flow_complete = False  # False when the search stopped once the monsters were reached
+        self.version = 0  # Incremented each time an element or the fog changes, to know when to draw again
         self._rooms = []
-        self._rooms_to_reach = []
+        self._reached = set()  # Ids of the rooms reached by the corridors, while they are dug
+        self._room_list = []  # The room of each id, minus one
+        self._room_ids = np.zeros((size, size), dtype=np.int32)  # Id of the room of each cell, 0 outside the rooms
         self.floor_number = floor_number
         self.special_room = special_room
 
-        for i in range(size):
-            self._mat.append([Map.empty] * size)
         if hero is None:
             hero = Hero()
         self.hero = hero
-        self.generate_rooms(7)
-        self.reach_all_rooms()
 
         # Graphics
-
-        self.graphic_map = []
-        CG.generate_graphic_map(self)
+        self.tile_codes = None  # Computed with the layout when the floor is generated in another process
+        self.graphic_map = []  # Generated with the tiles on the first draw
         self.graphic_elements = []
-
-        for i in range(len(self.graphic_map)):
-            self.graphic_elements.append([None] * len(self.graphic_map))
-
-        self.put_room_objects()
-        if put_hero:
-            self.put(self._rooms[0].center(), hero)
-            self.hero.x = self._rooms[0].center().x
-            self.hero.y = self._rooms[0].center().y
-        for r in self._rooms:
-            r.decorate(self)
-
-        self.update_elements(0)
+        self.explored = np.zeros((size + 1, size + 1), dtype=bool)  # Cells of the graphic map without fog
+        self.fog_sources = None  # Positions from which the fog was last removed
+        self.terrain_surface = None  # Baked on the first draw
+        self.fog_surface = None
+        if not CG.headless:
+            for i in range(size + 1):
+                self.graphic_elements.append([None] * (size + 1))
+
+    def layout(self):
+        """Returns what was generated on the map as picklable data: the floor number and special room, the terrain,
+            the rooms, the tile codes and the elements in the order they were put, see Map.from_layout.
+            Elements are given by the reference of their prototype, and whether they are the prototype itself
+            or a copy of it. The hero is given by None. Last comes the state of the random generator of the floor."""
+        placements = []
+        for o in self._entities.values():
+            c = self._elem[o]
+            if o is self.hero:
+                placements.append((c.x, c.y, None, False))
+            else:
+                placements.append((c.x, c.y, o.proto_ref, o is Game.prototype(o.proto_ref)))
+        rooms = [(r.c1.x, r.c1.y, r.c2.x, r.c2.y) for r in self._rooms]
+        return (self.floor_number, self.special_room, self._terrain, rooms, CG.tile_codes(self), placements,
+                self.rng.getstate())
+
+    @classmethod
+    def from_layout(cls, layout, hero, put_hero=True):
+        """Builds the map generated by Map.layout, with the elements of this process."""
+        floor_number, special_room, terrain, rooms, tile_codes, placements, rng_state = layout
+        m = cls.__new__(cls)
+        m._setup(len(terrain), hero, floor_number, special_room, random_from_state(rng_state))
+        m._terrain[:] = terrain
+        m._rooms = [m.index_room(Room(Coord(x1, y1), Coord(x2, y2))) for x1, y1, x2, y2 in rooms]
+        m.tile_codes = tile_codes
+
+        for x, y, ref, shared in placements:
+            if ref is None:
+                if put_hero:
+                    m.put(Coord(x, y), hero)
+            elif shared:
+                m.put(Coord(x, y), Game.prototype(ref))
+            else:
+                m.put(Coord(x, y), copy.copy(Game.prototype(ref)))
+
+        if not CG.headless:
+            m.update_elements(0)
+        return m
+
+    def save_state(self, element_state):
+        """Returns what is saved of the map: a dict of plain values, the elements being saved by element_state,
+            and the terrain and fog arrays."""
+        state = {"floor_number": self.floor_number,
+                 "special_room": self.special_room,
+                 "rooms": [(r.c1.x, r.c1.y, r.c2.x, r.c2.y) for r in self._rooms],
+                 "elements": [(self._elem[o].x, self._elem[o].y, element_state(o)) for o in self._entities.values()],
+                 "rng": self.rng.getstate()}
+        return state, self._terrain, self.explored
+
+    @classmethod
+    def from_save(cls, state, terrain, explored, hero, element_from_state):
+        """Builds the map saved by Map.save_state. The arrays are used as they are, memory mapped ones included."""
+        m = cls.__new__(cls)
+        m._setup(len(terrain), hero, state["floor_number"], state["special_room"], random_from_state(state["rng"]))
+        m._terrain = terrain
+        m.explored = explored
+        m._rooms = [m.index_room(Room(Coord(x1, y1), Coord(x2, y2))) for x1, y1, x2, y2 in state["rooms"]]
+        for x, y, elem in state["elements"]:
+            m.put(Coord(x, y), element_from_state(elem))
+
+        if not CG.headless:
+            m.update_elements(0)
+        return m
 
     def add_room(self, room):
-        """Adds a room in the map."""
-        self._rooms_to_reach.append(room)
-        for y in range(room.c1.y, room.c2.y + 1):
-            for x in range(room.c1.x, room.c2.x + 1):
-                self._mat[y][x] = Map.ground
+        """Adds a room in the map, to be reached by the corridors."""
+        self.index_room(room)
+        self._terrain[room.c1.y:room.c2.y + 1, room.c1.x:room.c2.x + 1] = Map.GROUND_TILE
+        self.terrain_changed()
+
+    def index_room(self, room):
+        """Gives the next id to the room and writes it on its cells. Returns the room."""
+        self._room_list.append(room)
+        self._room_ids[room.c1.y:room.c2.y + 1, room.c1.x:room.c2.x + 1] = len(self._room_list)
+        return room
 
     def find_room(self, coord):
         """If the coord belongs to a room, returns the room elsewhere returns None"""
-        for r in self._rooms_to_reach:
-            if coord in r:
-                return r
-        return None
+        room_id = self._room_ids[coord.y, coord.x]
+        return self._room_list[room_id - 1] if room_id else None
 
-    def intersect_none(self, room):
-        """Tests if the room shall intersect any room already in the map."""
-        for r in self._rooms_to_reach:
-            if room.intersect(r):
-                return False
-        return True
+    def reach_room(self, room_id):
+        """Moves the room of this id to the reached rooms, if it was not reached yet."""
+        if room_id not in self._reached:
+            self._reached.add(room_id)
+            self._rooms.append(self._room_list[room_id - 1])
 
-    def dig(self, coord):
-        """Puts a ground cell at the given coord.
-            If the coord corresponds to a room, considers the room reached."""
-        self._mat[coord.y][coord.x] = Map.ground
-        r = self.find_room(coord)
-        if r:
-            self._rooms_to_reach.remove(r)
-            self._rooms.append(r)
+    def intersect_none(self, room):
+        """Tests if the room shall intersect any room already in the map.
+            Until the corridors are dug the ground cells are the rooms, so the terrain is tested instead of each room."""
+        return not self._terrain[room.c1.y:room.c2.y + 1, room.c1.x:room.c2.x + 1].any()
 
     def corridor(self, cursor, end):
-        """Digs a corridors from the coordinates cursor to the end, first vertically, then horizontally."""
-        d = end - cursor
-        self.dig(cursor)
-        while cursor.y != end.y:
-            cursor = cursor + Coord(0, sign(d.y))
-            self.dig(cursor)
-        while cursor.x != end.x:
-            cursor = cursor + Coord(sign(d.x), 0)
-            self.dig(cursor)
-
-    def reach(self):
-        """Makes more rooms reachable.
-            Start from one random reached room, and dig a corridor to an unreached room."""
-        room_a = random.choice(self._rooms)
-        room_b = random.choice(self._rooms_to_reach)
-
-        self.corridor(room_a.center(), room_b.center())
-
-    def reach_all_rooms(self):
-        """Makes all rooms reachable.
-            Start from the first room, repeats @reach until all rooms are reached."""
-        self._rooms.append(self._rooms_to_reach.pop(0))
-        while len(self._rooms_to_reach) > 0:
-            self.reach()
-
-    def put_room_objects(self):
+        """Digs a corridors from the coordinates cursor to the end, first vertically, then horizontally.
+            Each part is dug as a slice of the terrain, and the rooms it goes through are reached."""
+        y0, y1 = sorted((cursor.y, end.y))
+        x0, x1 = sorted((cursor.x, end.x))
+        for part in ((slice(y0, y1 + 1), cursor.x), (end.y, slice(x0, x1 + 1))):
+            self._terrain[part] = Map.GROUND_TILE
+            for room_id in set(self._room_ids[part].tolist()):
+                if room_id:
+                    self.reach_room(room_id)
+        self.terrain_changed()
+
+    def plan_corridors(self, rooms, loops=0):
+        """Returns the pairs of indexes of the rooms to link by a corridor: a minimum spanning tree over their
+            centers, a corridor being as long as the Manhattan distance between them (Prim), then loops extra
+            corridors from random rooms to their nearest room which is not linked to them yet."""
+        n = len(rooms)
+        if n < 2:
+            return []
+        xs = np.array([r.center().x for r in rooms])
+        ys = np.array([r.center().y for r in rooms])
+        far = np.iinfo(xs.dtype).max
+
+        in_tree = np.zeros(n, dtype=bool)
+        in_tree[0] = True
+        best = np.abs(xs - xs[0]) + np.abs(ys - ys[0])  # Length of the shortest corridor to the tree
+        best[0] = far
+        parent = np.zeros(n, dtype=int)
+        links = []
+        for _ in range(n - 1):
+            i = int(np.argmin(best))
+            links.append((int(parent[i]), i))
+            in_tree[i] = True
+            best[i] = far
+            d = np.abs(xs - xs[i]) + np.abs(ys - ys[i])
+            closer = d < best
+            closer &= ~in_tree
+            best[closer] = d[closer]
+            parent[closer] = i
+
+        linked = set(links) | {(j, i) for i, j in links}
+        for _ in range(loops):
+            i = self.rng.randrange(n)
+            d = np.abs(xs - xs[i]) + np.abs(ys - ys[i])
+            d[i] = far
+            for j in np.argsort(d):
+                j = int(j)
+                if j != i and (i, j) not in linked:
+                    links.append((i, j))
+                    linked |= {(i, j), (j, i)}
+                    break
+        return links
+
+    def reach_all_rooms(self, loop_ratio=None):
+        """Makes all rooms reachable: digs the corridors planned by plan_corridors, with one loop for every
+            1 / loop_ratio rooms (Map.loop_ratio by default)."""
+        if loop_ratio is None:
+            loop_ratio = Map.loop_ratio
+        rooms = self._room_list
+        self.reach_room(1)
+        for i, j in self.plan_corridors(rooms, round(loop_ratio * len(rooms))):
+            self.corridor(rooms[i].center(), rooms[j].center())
+
+    def rooms_connected(self):
+        """Checks by a flood fill from the first room that the center of every room can be walked to.
+            The corridors of reach_all_rooms always link all the rooms, the benchmarks check it on large maps."""
+        flow, _ = self._compute_flow(self._rooms[0].center())
+        w = self._size + 2
+        return all((r.center().y + 1) * w + r.center().x + 1 in flow for r in self._room_list)
+
+    def put_room_objects(self, nb_floors):
         for key in Game._room_objects:
             if key == "downstair" and self.floor_number > 0:
-                r = random.choice(self._rooms)
+                r = self.rng.choice(self._rooms)
                 r.specialObjects.append(Game._room_objects[key])
-            if key == "upstair" and self.floor_number + 1 < the_game().nb_floors:
-                r = random.choice(self._rooms)
+            if key == "upstair" and self.floor_number + 1 < nb_floors:
+                r = self.rng.choice(self._rooms)
                 r.specialObjects.append(Game._room_objects[key])
 
-    def rand_room(self):
-        """A random room to be put on the map."""
-        c1 = Coord(random.randint(0, len(self) - 3), random.randint(0, len(self) - 3))
-        c2 = Coord(min(c1.x + random.randint(3, 8), len(self) - 1), min(c1.y + random.randint(3, 8), len(self) - 1))
+    def rand_room(self, rng=None):
+        """A random room to be put on the map, drawn with the random generator of the map by default."""
+        if rng is None:
+            rng = self.rng
+        c1 = Coord(rng.randint(0, len(self) - 3), rng.randint(0, len(self) - 3))
+        c2 = Coord(min(c1.x + rng.randint(*Map.room_extents), len(self) - 1),
+                   min(c1.y + rng.randint(*Map.room_extents), len(self) - 1))
         return Room(c1, c2)
 
-    def generate_rooms(self, n):
-        """Generates n random rooms and adds them if non-intersecting."""
+    def generate_rooms(self, n=None, density=None):
+        """Adds random rooms which do not intersect until there are n of them, or until they cover the part density
+            of the map. None means no bound: the placement stops anyway after Map.placement_tries rooms in a row
+            which do not fit. The special room of the floor comes first."""
+        covered = 0
         if self.special_room is not None:
-            self.add_room(Game._special_rooms_list[self.special_room])
-        for i in range(n):
+            special = Game._special_rooms_list[self.special_room]
+            # The creatures of the room fight on this floor only, each map gets its own copy
+            room = Room(special.c1, special.c2,
+                        [copy.copy(o) if isinstance(o, Creature) else o for o in special.specialObjects])
+            self.add_room(room)
+            covered += room.area()
+
+        max_covered = None if density is None else density * len(self) ** 2
+        failures = 0
+        while failures < Map.placement_tries:
+            if n is not None and len(self._room_list) >= n:
+                break
+            if max_covered is not None and covered >= max_covered:
+                break
             r = self.rand_room()
             if self.intersect_none(r):
                 self.add_room(r)
+                covered += r.area()
+                failures = 0
+            else:
+                failures += 1
 
     def __len__(self):
-        return len(self._mat)
+        return self._size
 
     def __contains__(self, item):
         if isinstance(item, Coord):
-            return 0 <= item.x < len(self) and 0 <= item.y < len(self)
+            return 0 <= item.x < self._size and 0 <= item.y < self._size
         return item in self._elem
 
     def in_graphic_map(self, c):
-        return 0 <= c.x < len(self.graphic_map) and 0 <= c.y < len(self.graphic_map)
+        return 0 <= c.x < len(self.graphic_elements) and 0 <= c.y < len(self.graphic_elements)
+
+    @staticmethod
+    def disk(radius):
+        """Returns the mask of the cells at distance at most radius from the center of a square of side 2 * radius + 1.
+            Masks are computed once per radius."""
+        if radius not in Map._disks:
+            r = np.arange(-radius, radius + 1)
+            Map._disks[radius] = r[np.newaxis, :] ** 2 + r[:, np.newaxis] ** 2 <= radius * radius
+        return Map._disks[radius]
+
+    def reveal_around(self, x, y, radius):
+        """Removes the fog of the cells of the graphic map at distance at most radius from (x, y)."""
+        n = len(self.explored)
+        x0, x1 = max(x - radius, 0), min(x + radius + 1, n)
+        y0, y1 = max(y - radius, 0), min(y + radius + 1, n)
+        if x0 >= x1 or y0 >= y1:
+            return
+
+        mask = Map.disk(radius)[y0 - y + radius:y1 - y + radius, x0 - x + radius:x1 - x + radius]
+        region = self.explored[y0:y1, x0:x1]
+        revealed = mask & ~region
+        if not revealed.any():
+            return
+
+        region |= revealed
+        self.version += 1
+        if self.fog_surface is not None:
+            for j, i in zip(*np.nonzero(revealed)):
+                self.fog_surface.fill((0, 0, 0, 0), ((x0 + i) * Map.sizeFactor, (y0 + j) * Map.sizeFactor,
+                                                     Map.sizeFactor, Map.sizeFactor))
 
     def __repr__(self):
         s = ""
-        for i in self._mat:
-            for j in i:
-                s += str(j)
+        for y in range(self._size):
+            for x in range(self._size):
+                s += str(self._cell(x, y))
             s += '\n'
         return s
 
+    def terrain_changed(self):
+        """Invalidates what is computed from the terrain."""
+        self.tile_codes = None
+        self._walkable = None
+        self._flow = None
+
+    def ground_mask(self):
+        """Returns a boolean array, True where the terrain is walkable ground."""
+        return self._terrain == Map.GROUND_TILE
+
+    def observation(self):
+        """Returns the map as a (2, size, size) array: the terrain codes and the kind of element on each cell
+            (0: nothing, 1: hero, 2: creature, 3: equipment, 4: room object)."""
+        kinds = np.zeros((self._size, self._size), dtype=np.uint8)
+        for o, c in self._elem.items():
+            if isinstance(o, Hero):
+                kinds[c.y, c.x] = 1
+            elif isinstance(o, Creature):
+                kinds[c.y, c.x] = 2
+            elif isinstance(o, Equipment):
+                kinds[c.y, c.x] = 3
+            elif isinstance(o, RoomObject):
+                kinds[c.y, c.x] = 4
+        return np.stack((self._terrain, kinds))
+
     def check_coord(self, c):
         """Check if the coordinates c is valid in the map."""
         if not isinstance(c, Coord):
@@ -1172,24 +1503,44 @@ class Map(object):
         """Puts an element o on the cell c"""
         self.check_coord(c)
         self.check_element(o)
-        if self._mat[c.y][c.x] != Map.ground:
+        if self._terrain[c.y, c.x] != Map.GROUND_TILE or self._entity_ids[c.y, c.x]:
             raise ValueError('Incorrect cell')
         if o in self._elem:
             raise KeyError('Already placed')
-        self._mat[c.y][c.x] = o
+        entity_id = self._next_entity_id
+        self._next_entity_id += 1
+        self._entity_ids[c.y, c.x] = entity_id
+        self._entities[entity_id] = o
         self._elem[o] = c
+        self.version += 1
+        if isinstance(o, Creature):
+            self._creature_buckets.setdefault(self.bucket(c), {})[o] = None
+            if o.proto_ref == Game.boss_ref:
+                self.boss = o
+        if isinstance(o, Hero):
+            o.x, o.y = c.x, c.y
+
+    def _cell(self, x, y):
+        """Returns the object present on the cell (x, y), which must be in the map."""
+        entity_id = self._entity_ids[y, x]
+        if entity_id:
+            return self._entities[entity_id]
+        return Map._tiles[self._terrain[y, x]]
 
     def get(self, c):
         """Returns the object present on the cell c"""
-        try:
-            self.check_coord(c)
-        except IndexError:
+        return self.get_xy(c.x, c.y)
+
+    def get_xy(self, x, y):
+        """Returns the object present on the cell (x, y), empty outside of the map."""
+        if not (0 <= x < self._size and 0 <= y < self._size):
             return Map.empty
-        return self._mat[c.y][c.x]
+        return self._cell(x, y)
 
     def get_without_coord(self, x, y):
-        self.check_coord(Coord(x, y))
-        return self._mat[y][x]
+        if not (0 <= x < self._size and 0 <= y < self._size):
+            raise IndexError('Out of map coord')
+        return self._cell(x, y)
 
     def pos(self, o):
         """Returns the coordinates of an element in the map """
@@ -1202,8 +1553,14 @@ class Map(object):
     def rm(self, c):
         """Removes the element at the coordinates c"""
         self.check_coord(c)
-        del self._elem[self._mat[c.y][c.x]]
-        self._mat[c.y][c.x] = Map.ground
+        o = self._entities.pop(self._entity_ids[c.y, c.x])
+        del self._elem[o]
+        self._entity_ids[c.y, c.x] = 0
+        self.version += 1
+        if isinstance(o, Creature):
+            del self._creature_buckets[self.bucket(c)][o]
+            if o is self.boss:
+                self.boss = None
 
     def move(self, e, way):
         """Moves the element e in the direction way."""
@@ -1211,9 +1568,13 @@ class Map(object):
         dest = orig + way
         if dest in self:
             if self.get(dest) == Map.ground:
-                self._mat[orig.y][orig.x] = Map.ground
-                self._mat[dest.y][dest.x] = e
+                self._entity_ids[dest.y, dest.x] = self._entity_ids[orig.y, orig.x]
+                self._entity_ids[orig.y, orig.x] = 0
                 self._elem[e] = dest
+                self.version += 1
+                if isinstance(e, Creature) and self.bucket(orig) != self.bucket(dest):
+                    del self._creature_buckets[self.bucket(orig)][e]
+                    self._creature_buckets.setdefault(self.bucket(dest), {})[e] = None
                 if isinstance(e, Hero):
                     self.hero.x, self.hero.y = dest.x, dest.y
             elif isinstance(self.get(dest), RoomObject) and self.get(dest).meet(e):
@@ -1221,6 +1582,24 @@ class Map(object):
             elif self.get(dest) != Map.empty and self.get(dest).meet(e) and self.get(dest) != self.hero:
                 self.rm(dest)
 
+    @staticmethod
+    def bucket(c):
+        """Returns the key of the spatial index square containing c."""
+        return c.x // Map.bucket_size, c.y // Map.bucket_size
+
+    def creatures_within(self, center, radius):
+        """Returns the creatures at a distance lower than radius from center, in the order they were put on the map.
+            Only the squares of the spatial index overlapping the disk are visited."""
+        res = []
+        s = Map.bucket_size
+        for by in range((center.y - radius) // s, (center.y + radius) // s + 1):
+            for bx in range((center.x - radius) // s, (center.x + radius) // s + 1):
+                for creature in self._creature_buckets.get((bx, by), ()):
+                    if self._elem[creature].square_distance(center) < radius * radius:
+                        res.append(creature)
+        res.sort(key=lambda creature: self._entity_ids[self._elem[creature].y, self._elem[creature].x])
+        return res
+
     def check_move(self, e, way):
         """Returns element in way"""
         orig = self.pos(e)
@@ -1230,52 +1609,141 @@ class Map(object):
         return self.empty
 
     def direction(self, c1, c2):
-        """Returns the direction between two coordinates."""
-        final_way = Coord(0, 0)
-        for i in range(-1, 2):
-            for j in range(-1, 2):
-                way = Coord(i, j)
-                in_map = 0 <= c1.x + way.x < len(self._mat) and 0 <= c1.y + way.y < len(self._mat)
-                if in_map and (c1 + way).distance(c2) < (c1 + final_way).distance(c2) and (self.get(
-                        c1 + way) == self.ground or self.get(c1 + way) == self.hero):
+        """Returns the direction between two coordinates.
+            The closest way to c2 is the one of the signs of the difference, which is tried first."""
+        dx, dy = c2.x - c1.x, c2.y - c1.y
+        way = Map.around[((dx > 0) - (dx < 0) + 1) * 3 + (dy > 0) - (dy < 0) + 1]
+        cell = self.get_xy(c1.x + way.x, c1.y + way.y)
+        if cell == self.ground or cell == self.hero:
+            return way
+
+        final_way = Map.around[4]  # Coord(0, 0)
+        best = c1.square_distance(c2)
+        for way in Map.around:
+            x, y = c1.x + way.x, c1.y + way.y
+            dx, dy = x - c2.x, y - c2.y
+            if dx * dx + dy * dy < best:
+                cell = self.get_xy(x, y)
+                if cell == self.ground or cell == self.hero:
+                    final_way = way
+                    best = dx * dx + dy * dy
+        return final_way
+
+    def _update_flow(self, cells):
+        """Computes the flow field again if the hero moved, the terrain changed or one of cells was not reached.
+            The field is shared by all monsters and only covers the cells around the hero which they need."""
+        h = self.pos(self.hero)
+        w = self._size + 2
+        if self._flow is None or self._flow_origin != h or \
+                not self._flow_complete and any((c.y + 1) * w + c.x + 1 not in self._flow for c in cells):
+            self._flow, self._flow_complete = self._compute_flow(h, cells, Map.flow_depth)
+            self._flow_origin = h
+
+    def _compute_flow(self, origin, targets=(), max_depth=None):
+        """Breadth first search on ground cells from origin, on the map flattened with a border of empty cells.
+            Returns the distances of the cells reached, by index, and whether every cell up to max_depth was reached:
+            the search stops as soon as all the targets are reached, the cells nearer than them are known then."""
+        w = self._size + 2
+        if self._walkable is None:
+            walkable = np.zeros((w, w), dtype=bool)
+            walkable[1:-1, 1:-1] = self.ground_mask()
+            self._walkable = walkable.tobytes()
+        walkable = self._walkable
+
+        start = (origin.y + 1) * w + origin.x + 1
+        flow = {start: 0}
+        remaining = {(c.y + 1) * w + c.x + 1 for c in targets} - {start}
+        offsets = [way.y * w + way.x for way in Map.around if way.x or way.y]
+        frontier = [start]
+        d = 0
+        while frontier and (max_depth is None or d < max_depth):
+            d += 1
+            reached = []
+            for i in frontier:
+                for o in offsets:
+                    j = i + o
+                    if walkable[j] and j not in flow:
+                        flow[j] = d
+                        reached.append(j)
+            if remaining:
+                remaining.difference_update(reached)
+                if not remaining:
+                    return flow, False
+            frontier = reached
+        return flow, True
+
+    def flow_direction(self, c):
+        """Returns the way a monster at c takes to get closer to the hero, following the flow field,
+            which _update_flow must have computed for c. Only free cells are considered, so the monster stays in
+            place when others block its path."""
+        w = self._size + 2
+        i = (c.y + 1) * w + c.x + 1
+        best = self._flow.get(i)
+        if best is None:
+            return self.direction(c, self._flow_origin)
+
+        final_way = Map.around[4]  # Coord(0, 0)
+        for way in Map.around:
+            d = self._flow.get(i + way.y * w + way.x, best)
+            if d < best:
+                cell = self._cell(c.x + way.x, c.y + way.y)
+                if cell == Map.ground or cell == self.hero:
                     final_way = way
+                    best = d
         return final_way
 
     def move_all_monsters(self):
         """Moves all monsters in the map.
-            If a monster is at distance lower than 6 from the hero, the monster advances."""
-
+            If a monster is at distance lower than aggro_radius from the hero, the monster advances towards it:
+            by the greedy step of direction in the room of the hero, where no wall is in the way, along the flow field
+            otherwise. The field is only computed for the monsters outside the room of the hero."""
         h = self.pos(self.hero)
-        for e in self._elem:
+        monsters = [e for e in self.creatures_within(h, Map.aggro_radius) if e != self.hero]
+        if not monsters:
+            return
+        room = self.find_room(h)
+        in_room = {e for e in monsters if room is not None and self.find_room(self.pos(e)) is room}
+        others = [self.pos(e) for e in monsters if e not in in_room]
+        if others:
+            self._update_flow(others)
+        for e in monsters:
             c = self.pos(e)
-            if isinstance(e, Creature) and e != self.hero and c.distance(h) < 6:
-                d = self.direction(c, h)
-                if self.get(c + d) in [Map.ground, self.hero]:
-                    self.move(e, d)
+            d = self.direction(c, h) if e in in_room else self.flow_direction(c)
+            if self.get(c + d) in [Map.ground, self.hero]:
+                self.move(e, d)
 
     def update_elements(self, state):
         clear_list(self.graphic_elements)
-        for y in range(len(self._mat)):
-            for x in range(len(self._mat)):
-
-                elem = self.get(Coord(x, y))
-                if elem != self.ground and elem != self.empty:
-                    if isinstance(elem, Hero):
-                        elem.x = x
-                        elem.y = y
-                    elif isinstance(elem, Creature):
-                        self.graphic_elements[y][x] = elem.graphicOutput[state]
-                    elif isinstance(elem, Equipment):
-                        self.graphic_elements[y][x] = elem.graphicOutput[0]
-                    elif isinstance(elem, RoomObject):
-                        if len(elem.graphicOutput) == 2:
-                            self.graphic_elements[y][x] = elem.graphicOutput[state]
-                        else:
-                            self.graphic_elements[y][x] = elem.graphicOutput[0]
+        for elem, c in self._elem.items():
+            x, y = c.x, c.y
+            if isinstance(elem, Hero):
+                elem.x = x
+                elem.y = y
+            elif isinstance(elem, Creature):
+                self.graphic_elements[y][x] = elem.graphicOutput[state]
+            elif isinstance(elem, Equipment):
+                self.graphic_elements[y][x] = elem.graphicOutput[0]
+            elif isinstance(elem, RoomObject):
+                if len(elem.graphicOutput) == 2:
+                    self.graphic_elements[y][x] = elem.graphicOutput[state]
+                else:
+                    self.graphic_elements[y][x] = elem.graphicOutput[0]
         the_game().gv.update_fog(self)
 
 
 class GraphicVariables(object):
+    # The game logic runs in ticks of TICK ms, at most MAX_LAG ms of them between two frames so that the game slows
+    # down instead of freezing when a frame is slow. The frames are drawn at most FPS times per second.
+    TICK = 50
+    MAX_LAG = 250
+    FPS = 60
+    MONSTER_FRAME_TIME = 550  # ms between the two animation frames of the monsters
+    MESSAGE_LINES = 5  # Lines of the message box
+
+    # Directions of the hero for each index of Hero.moving_UDLR
+    moving_ways = (Coord(0, -1), Coord(0, 1), Coord(-1, 0), Coord(1, 0),
+                   Coord(-1, -1), Coord(1, -1), Coord(1, 1), Coord(-1, 1))
+
     def __init__(self, hero):
 
         self.height = None
@@ -1289,8 +1757,10 @@ class GraphicVariables(object):
 
         # Frames
         self.running = True
-        self.frame_count = 0
+        self.monster_time = 0
         self.monster_state = 0
+        self.attack_ticks = 0  # Ticks left to the explosion of the attack of the hero
+        self.explosion_cell = None
 
         self.stop = False
         self.choice = 0
@@ -1300,14 +1770,16 @@ class GraphicVariables(object):
         # Messages
         self.game_font = None
         self.menu_font = None
-        self._msg = []
+        self._msg = deque(maxlen=GraphicVariables.MESSAGE_LINES)  # (rendered line, tick it expires at)
+        self._msg_panel = None
+        self.msg_ticks = 0  # Logic ticks run with the game screen shown, the messages age only then
 
         self.qwerty = False
 
-        self.options_menu_start = [("Menu", False), ("", False), ("New Game", True), ("Preferences", True),
-                                   ("Exit Game", True)]
-        self.options_menu = [("Menu", False), ("", False), ("Resume Game", True), ("Preferences", True),
-                             ("Exit Game", True)]
+        self.options_menu_start = [("Menu", False), ("", False), ("New Game", True), ("Load Game", True),
+                                   ("Preferences", True), ("Exit Game", True)]
+        self.options_menu = [("Menu", False), ("", False), ("Resume Game", True), ("Save Game", True),
+                             ("Preferences", True), ("Exit Game", True)]
         self.options_hero = [("Characters", False), ("", False), ("Template", True), ("Rogue", True),
                              ("Engineer", True), ("Warrior", True), ("Mage", True), ("Paladin", True)]
         self.options_controls = [
@@ -1335,11 +1807,32 @@ class GraphicVariables(object):
         self.list_menu = self.options_menu_start
         self.colour_menu = (140, 140, 150)
 
-        # Game Surfaces
+        # Game Surfaces, loaded by load_surfaces once the display exists
+        self.explosion = []
+        self.hearts = []
+        self.black_hearts = []
+        self.xp_bord = []
+        self.blockSpace = None
+        self.fog = None
+        self.food = []
+        self.dollar = None
+        self.arrow = None
+        self.map_background = None  # Fog covering the left half of the screen, drawn once
+
+        # What was displayed on the last draw of each part of the screen, to draw only what changed
+        self._gui_key = None
+        self._game_screen_key = None
+        self._menu_key = None
+        self._msg_changed = True
+
+        # Music effects
+        self._songs = ['song-1.mp3', 'song-2.mp3', 'song-3.mp3']
+
+    def load_surfaces(self):
+        """Loads the images of the interface."""
         self.explosion = []
         for i in range(6):
-            image = CG.get_image("Animations/explosion-" + str(i) + ".png")
-            self.explosion.append(pygame.transform.scale(image, (40, 40)))
+            self.explosion.append(CG.get_image("Animations/explosion-" + str(i) + ".png", (40, 40)))
 
         self.hearts = []
         for i in range(5):
@@ -1357,22 +1850,35 @@ class GraphicVariables(object):
         for i in range(3):
             self.xp_bord.append(CG.get_image("GUI/bordexp" + str(i) + ".png"))
 
-        self.blockSpace = pygame.transform.scale(CG.get_image("GUI/blockSpace.png"), (32, 32))
+        self.blockSpace = CG.get_image("GUI/blockSpace.png", (32, 32))
         self.fog = CG.get_image("Background/Void.png")
-
         self.food = [CG.get_image("GUI/food0.png"), CG.get_image("GUI/food1.png")]
         self.dollar = CG.get_image("GUI/dollar.png")
         self.arrow = CG.get_image("GUI/arrow.png")
 
-        # Music effects
-        self._songs = ['song-1.mp3', 'song-2.mp3', 'song-3.mp3']
+    def invalidate(self):
+        """Forces every part of the screen to be drawn again on the next frame."""
+        self._gui_key = None
+        self._game_screen_key = None
+        self._menu_key = None
+        self._msg_changed = True
 
     def draw_gui(self, state):
+        """Draws the right part of the screen if what it shows changed. Returns the changed rectangles."""
+        key = (state, self.hero.graphicOutput, self.hero.hp, self.hero.stomach, self.hero.xp, self.hero.level_step,
+               self.hero.level, self.hero.strength, self.hero.gold, tuple(self.hero.weapon_slot),
+               tuple(self.hero._inventory), self.inventory_on, self.choice_inv,
+               tuple(the_game().effects.of(self.hero)))
+        if key == self._gui_key:
+            return []
+        self._gui_key = key
+        self._msg_changed = True  # The message box is covered
+
         self.screen.fill((72, 62, 87), (self.width / 2, 0, self.width / 2, self.height))
 
         # Draw Character
         scale = round(self.height / 5)
-        hero_image = pygame.transform.scale(self.hero.graphicOutput, (scale, scale))
+        hero_image = CG.scale_image(self.hero.graphicOutput, (scale, scale))
         hero_drawing_x = (self.width / 2) * (1 + 1 / 10)
         self.screen.blit(hero_image, (hero_drawing_x, self.height / 10))
         h_d_width = 200
@@ -1416,22 +1922,21 @@ class GraphicVariables(object):
                                  (hero_drawing_x + h_d_width + 18 * i, self.height * 3 / 20 + 50))
 
         # Draw Hero Level
-        text = self.game_font.render('Level: ' + str(self.hero.level), True, (0, 0, 0))
+        text = CG.render_text(self.game_font, 'Level: ' + str(self.hero.level))
         self.screen.blit(text, (hero_drawing_x + h_d_width, self.height * 3 / 20 - 58))
 
         # Draw Hero Strength
-        text = self.game_font.render('Strength: ' + str(self.hero.strength), True, (0, 0, 0))
+        text = CG.render_text(self.game_font, 'Strength: ' + str(self.hero.strength))
         self.screen.blit(text, (hero_drawing_x + h_d_width, self.height * 3 / 20 - 30))
 
         # Draw gold
         self.screen.blit(self.dollar, (hero_drawing_x + h_d_width, self.height * 3 / 20 + 75))
-        text = self.game_font.render(str(self.hero.gold), True, (0, 0, 0))
+        text = CG.render_text(self.game_font, str(self.hero.gold))
         self.screen.blit(text, (hero_drawing_x + h_d_width + 30, self.height * 3 / 20 + 76))
 
         # Effects
-        for i, x in enumerate(the_game().active_effects):
-            if x.creature == self.hero:
-                self.screen.blit(x.graphicOutput, (hero_drawing_x + h_d_width + 32 * i, self.height * 3 / 20 + 100))
+        for i, x in enumerate(the_game().effects.of(self.hero)):
+            self.screen.blit(x.graphicOutput, (hero_drawing_x + h_d_width + 32 * i, self.height * 3 / 20 + 100))
 
         # Inventory
         sf = 2
@@ -1445,10 +1950,7 @@ class GraphicVariables(object):
         for i in range(Hero.default_inventory_size):
             self.screen.blit(self.blockSpace, (self.width / 2 * (1 + 3 / 10) + case * i * sf, self.height * 7 / 20))
             if i < len(self.hero._inventory):
-                if sf != 1:
-                    image = pygame.transform.scale(self.hero._inventory[i].graphicOutput[1], (16 * sf, 16 * sf))
-                else:
-                    image = self.hero._inventory[i].graphicOutput[1]
+                image = CG.scale_image(self.hero._inventory[i].graphicOutput[1], (16 * sf, 16 * sf))
                 self.screen.blit(image, (self.width / 2 * (1 + 3 / 10) + case * i * sf, self.height * 7 / 20))
 
         # Arrow Inventory
@@ -1457,81 +1959,97 @@ class GraphicVariables(object):
                 self.choice_inv %= len(self.hero._inventory)
             else:
                 self.choice_inv = 0
-            if sf != 2:
-                image = pygame.transform.scale(self.arrow, (16 * sf, 16 * sf))
-            else:
-                image = self.arrow
+            image = CG.scale_image(self.arrow, (16 * sf, 16 * sf))
             self.screen.blit(image, (
                 self.width / 2 * (1 + 3 / 10) + 7 + case * self.choice_inv * sf, self.height * 7 / 20 - 21))
 
+        return [pygame.Rect(self.width / 2, 0, self.width / 2, self.height)]
+
     def draw_map(self):
-        self.screen.fill((80, 74, 85), (0, 0, self.width / 2, self.height))
-        for y in range(self.height // Map.sizeFactor):
-            for x in range(self.width // (2 * Map.sizeFactor)):
-                self.screen.blit(self.fog, (x * Map.sizeFactor, y * Map.sizeFactor))
-
-        for y in range(len(self.floor.graphic_map)):
-            for x in range(len(self.floor.graphic_map[y])):
-                pos = (Map.sizeFactor * x + self.orig_x, Map.sizeFactor * y + self.orig_y)
-                if self.floor.graphic_map[y][x][1]:
-                    self.screen.blit(self.floor.graphic_map[y][x][0], pos)
-                else:
-                    self.screen.blit(self.fog, pos)
+        if self.map_background is None:
+            self.map_background = pygame.Surface((self.width / 2, self.height))
+            self.map_background.fill((80, 74, 85))
+            for y in range(self.height // Map.sizeFactor):
+                for x in range(self.width // (2 * Map.sizeFactor)):
+                    self.map_background.blit(self.fog, (x * Map.sizeFactor, y * Map.sizeFactor))
+        rect = self.screen.blit(self.map_background, (0, 0))
+
+        if self.floor.terrain_surface is None:
+            CG.bake_floor(self.floor, self.fog)
+        self.screen.blit(self.floor.terrain_surface, (self.orig_x, self.orig_y))
+        self.screen.blit(self.floor.fog_surface, (self.orig_x, self.orig_y))
 
         # Draw Map level
         string = f"Floor number: {the_game().floor_list[the_game().actual_floor].floor_number + 1} / {the_game().nb_floors}"
-        text = self.game_font.render(string, True, (0, 0, 0))
+        text = CG.render_text(self.game_font, string)
 
-        text_width, text_height = self.game_font.size(string)
+        text_width, text_height = text.get_size()
         self.screen.fill((72, 62, 87), (45, self.orig_y / 3 - 5, text_width + 10, text_height + 10))
         self.screen.blit(text, (50, self.orig_y / 3))
+        return [rect]
 
     def draw_elements(self, monster_state):
+        rects = []
         self.floor.update_elements(monster_state)
         for y in range(len(self.floor.graphic_elements)):
             for x in range(len(self.floor.graphic_elements)):
                 case = self.floor.graphic_elements[y][x]
-                if case is not None and self.floor.graphic_map[y][x][1]:
-                    if isinstance(self.floor._mat[y][x], RoomObject):
-                        if self.floor._mat[y][x].name == "upstair":
+                if case is not None and self.floor.explored[y, x]:
+                    elem = self.floor.get_without_coord(x, y)
+                    if isinstance(elem, RoomObject):
+                        if elem.name == "upstair":
                             relief = 20
                         else:
                             relief = 0
                     else:
                         relief = Map.sizeFactor / 4
-                    self.screen.blit(case,
-                                     (Map.sizeFactor * x + self.orig_x, Map.sizeFactor * y + self.orig_y - relief))
+                    rects.append(self.screen.blit(case, (Map.sizeFactor * x + self.orig_x,
+                                                         Map.sizeFactor * y + self.orig_y - relief)))
+        return rects
 
     def draw_message(self, time):
-        # Draw Message self.screen
-        self.screen.fill((20, 12, 28), (
-            (self.width / 2) * (1 + 1 / 8), self.height * 3 / 4, (self.width / 2) * 6 / 8, self.height / 5))
+        """Draws the message box if a message arrived or expired, each message lasting time logic ticks of the game
+            screen, see msg_ticks. Returns the changed rectangles."""
+        now = self.msg_ticks
+        for k in the_game().read_messages():
+            self._msg.append((k, now + time))
+            self._msg_panel = None
+
+        # The messages all last as long, so the oldest ones expire first
+        while self._msg and self._msg[0][1] <= now:
+            self._msg.popleft()
+            self._msg_panel = None
+
+        if self._msg_panel is None:
+            self._msg_panel = self.render_message_panel()
+            self._msg_changed = True
+
+        if not self._msg_changed:
+            return []
+        self._msg_changed = False
+        return [self.screen.blit(self._msg_panel, ((self.width / 2) * (1 + 1 / 8), self.height * 3 / 4))]
+
+    def render_message_panel(self):
+        """Returns the message box with the messages shown, drawn again only when they change."""
+        width, height = (self.width / 2) * 6 / 8, self.height / 5
+        panel = pygame.Surface((width, height))
+        panel.fill((20, 12, 28))
         b = 5
-        self.screen.fill((140, 140, 150), (
-            (self.width / 2) * (1 + 1 / 8) + b, self.height * 3 / 4 + b, (self.width / 2) * 6 / 8 - 2 * b,
-            self.height / 5 - 2 * b))
-
-        new_msg = the_game().read_messages()
-        nb_lines = len(self._msg)
-        msg_nuls = []
-        for k in new_msg:
-            self._msg.append([k, time])
-            if len(self._msg) > 5:
-                self._msg.pop(0)
-        for i in range(nb_lines):
-            self.screen.blit(self._msg[i][0],
-                             ((self.width / 2) * (1 + 1 / 8) + 15, self.height * 3 / 4 + 5 + 20 * i + 10))
-            self._msg[i][1] -= 1
-            if self._msg[i][1] <= 0:
-                msg_nuls.append(i)
-
-        for j in msg_nuls:
-            if j < len(self._msg):
-                self._msg.pop(j)
+        panel.fill((140, 140, 150), (b, b, width - 2 * b, height - 2 * b))
+
+        for i, (text, expiry) in enumerate(self._msg):
+            panel.blit(text, (15, 5 + 20 * i + 10))
+        return panel
 
     def draw_menu(self, list_menu, colour=(140, 140, 150)):
+        """Draws the menu if it changed. Returns the changed rectangles."""
+        key = (tuple(list_menu), self.choice, colour)
+        if key == self._menu_key:
+            return []
+        self._menu_key = key
+
         menu_y = self.height / 6
-        self.screen.fill((255, 255, 51), (self.width / 4, menu_y, self.width / 2, self.height * 4 / 6))
+        rect = self.screen.fill((255, 255, 51), (self.width / 4, menu_y, self.width / 2, self.height * 4 / 6))
         b = 5
         self.screen.fill(colour,
                          (self.width / 4 + b, self.height / 6 + b, self.width / 2 - 2 * b, self.height * 4 / 6 - 2 * b))
@@ -1559,10 +2077,11 @@ class GraphicVariables(object):
             else:
                 objet = current_item
 
-            o_height = self.menu_font.size(objet)[1]
-            text = self.menu_font.render(f + objet, True, (0, 0, 0))
+            text = CG.render_text(self.menu_font, f + objet)
+            o_height = text.get_height()
             text_rect = text.get_rect(center=(self.width / 2, menu_y + (i + 1) * (o_height - 15)))
             self.screen.blit(text, text_rect)
+        return [rect]
 
     def draw_trader(self, list_objects):
         lm = [('Do you want something ?', False), ('', False)]
@@ -1575,75 +2094,75 @@ class GraphicVariables(object):
         self.colour_menu = (30, 212, 157)
         self.menu_on = True
 
-    def draw_hero_move(self):
+    def hero_way(self):
+        """Returns the direction the hero is moving in, None if it does not move."""
+        for moving, way in zip(self.hero.moving_UDLR, GraphicVariables.moving_ways):
+            if moving:
+                return way
+        return None
+
+    def update_hero_move(self):
+        """Advances the move of the hero by one logic tick: walking to the next cell takes 4 ticks,
+            an attack takes one tick per frame of the explosion."""
         h = self.hero
-        sf = Map.sizeFactor
-        persp = -sf / 4
+        if self.attack_ticks > 0:
+            self.attack_ticks -= 1
+            return
+
+        way = self.hero_way()
+        if way is None:
+            return
 
-        has_moved = False
-
-        way = Coord(0, 0)
-        if h.moving_UDLR[0]:
-            # UP
-            way += Coord(0, -1)
-        elif h.moving_UDLR[1]:
-            # DOWN
-            way += Coord(0, 1)
-        elif h.moving_UDLR[2]:
-            # LEFT
-            way += Coord(-1, 0)
-        elif h.moving_UDLR[3]:
-            # RIGHT
-            way += Coord(1, 0)
-        elif h.moving_UDLR[4]:
-            # UP LEFT
-            way += Coord(-1, -1)
-        elif h.moving_UDLR[5]:
-            # UP RIGHT
-            way += Coord(1, -1)
-        elif h.moving_UDLR[6]:
-            # DOWN RIGHT
-            way += Coord(1, 1)
-        elif h.moving_UDLR[7]:
-            # DOWN LEFT
-            way += Coord(-1, 1)
-
-        if way != Coord(0, 0):
-
-            elem_in_way = self.floor.check_move(h, way)
-            if elem_in_way == self.floor.ground:
-                pos = (sf * h.x + way.x * h.state * sf / 4 + self.orig_x,
-                       sf * h.y + way.y * h.state * sf / 4 + self.orig_y + persp)
-
-                self.screen.blit(h.animationUDLR[way.get_tuple()][h.state], pos)
-                h.state += 1
-                has_moved = True
-
-                if h.state >= 4:
-                    h.state = 0
-                    self.floor.move(h, way)
-                    self.newRound = True
-
-                    if self.stop:
-                        h.moving_UDLR = [False] * 8
-                        self.stop = False
-
-            elif isinstance(elem_in_way, Creature):
-                self.floor.move(h, way)
+        elem_in_way = self.floor.check_move(h, way)
+        if elem_in_way == self.floor.ground:
+            h.state += 1
+            if h.state >= 4:
+                h.state = 0
+                the_game().move_hero(way)
                 self.newRound = True
 
-                for i in range(6):
-                    self.screen.blit(self.explosion[i], (
-                        sf * (h.x + way.x) + self.orig_x - 12, sf * (h.y + way.y) + self.orig_y + persp - 12))
-                    self.screen.blit(h.graphicOutput, (sf * h.x + self.orig_x, sf * h.y + self.orig_y + persp))
-                    pygame.display.update()
-                    pygame.time.delay(50)
+                if self.stop:
+                    h.moving_UDLR = [False] * 8
+                    self.stop = False
 
-            elif isinstance(elem_in_way, Element):
-                self.floor.move(h, way)
+        elif isinstance(elem_in_way, Creature):
+            self.explosion_cell = Coord(h.x, h.y) + way
+            self.attack_ticks = len(self.explosion)
+            the_game().move_hero(way)
+            self.newRound = True
+
+        elif isinstance(elem_in_way, Element):
+            the_game().move_hero(way)
+
+    def draw_hero_move(self, alpha=0.):
+        """Draws the hero and the explosion of its attack. When it walks the hero is drawn between its cell and the
+            next one, alpha being the part of the logic tick elapsed since the last update. Returns the changed
+            rectangles."""
+        h = self.hero
+        sf = Map.sizeFactor
+        persp = -sf / 4
+        rects = []
+
+        if self.attack_ticks > 0:
+            c = self.explosion_cell
+            rects.append(self.screen.blit(self.explosion[len(self.explosion) - self.attack_ticks],
+                                          (sf * c.x + self.orig_x - 12, sf * c.y + self.orig_y + persp - 12)))
+
+        way = self.hero_way()
+        if way is not None and self.attack_ticks == 0 and self.floor.check_move(h, way) == self.floor.ground:
+            step = (h.state + alpha) * sf / 4
+            pos = (sf * h.x + way.x * step + self.orig_x, sf * h.y + way.y * step + self.orig_y + persp)
+            rects.append(self.screen.blit(h.animationUDLR[way][h.state], pos))
+        else:
+            rects.append(self.screen.blit(h.graphicOutput, (sf * h.x + self.orig_x, sf * h.y + self.orig_y + persp)))
+        return rects
 
-        if not has_moved:
-            self.screen.blit(h.graphicOutput, (sf * h.x + self.orig_x, sf * h.y + self.orig_y + persp))
+    def update_monster_state(self):
+        """Advances the animation of the monsters by one logic tick."""
+        self.monster_time += GraphicVariables.TICK
+        if self.monster_time >= GraphicVariables.MONSTER_FRAME_TIME:
+            self.monster_time = 0
+            self.monster_state = opp(self.monster_state)
 
     def player_plays(self, event):
         do = False
@@ -1719,13 +2238,13 @@ class GraphicVariables(object):
 
     def choose_action(self, event):
         if event.key == pygame.K_k:
-            Game._actions['k'](self.hero)
+            the_game().act('k')
         elif event.key == pygame.K_b:
-            Game._actions['b'](self.hero)
+            the_game().act('b')
         elif event.key == pygame.K_n:
-            Game._actions['n'](self.hero)
+            the_game().act('n')
         elif event.key == pygame.K_l:
-            Game._actions['l'](self.hero)
+            the_game().act('l')
 
     def choose_in_menu(self, event):
         move_choice = 0
@@ -1762,6 +2281,25 @@ class GraphicVariables(object):
             elif this_choice == "Resume Game" or this_choice == 'Maybe Later':
                 self.menu_on = not self.menu_on
 
+            elif this_choice == "Save Game":
+                the_game().save()
+                the_game().add_message("Game saved")
+                self.menu_on = False
+
+            elif this_choice == "Load Game":
+                if os.path.exists(Game.save_path):
+                    try:
+                        the_game().load()
+                    except ValueError as e:
+                        the_game().add_message("The game could not be loaded: " + str(e))
+                    else:
+                        the_game().stop_recording()
+                        the_game().add_message("Game loaded")
+                else:
+                    the_game().add_message("There is no saved game")
+                self.menu_on = False
+                self.list_menu = self.options_menu
+
             elif this_choice == "Exit Game":
                 self.running = False
 
@@ -1798,7 +2336,7 @@ class GraphicVariables(object):
             # Marchand
 
             elif isinstance(this_choice, Equipment):
-                self.hero.buy(this_choice)
+                the_game().buy_from_trader(self.choice)
                 self.menu_on = False
 
     def choose_in_inventory(self, event):
@@ -1822,44 +2360,45 @@ class GraphicVariables(object):
 
         # Use equipment
         if event.key == pygame.K_RETURN or event.key == pygame.K_u:
-            Game._actions['u'](self.hero)
+            the_game().select_item(self.choice_inv)
+            the_game().act('u')
             self.inventory_on = False
 
         elif event.key == pygame.K_t:
-            Game._actions["t"](self.hero)
+            the_game().select_item(self.choice_inv)
+            the_game().act('t')
             self.inventory_on = False
 
         elif event.key == pygame.K_b:
-            Game._actions["b"](self.hero)
+            the_game().act('b')
             self.inventory_on = False
 
         elif event.key == pygame.K_n:
-            Game._actions["n"](self.hero)
+            the_game().act('n')
             self.inventory_on = False
 
         elif event.key == pygame.K_l:
-            the_game().hero.throw_item(the_game().gv.select_from_inventory(Equipment), 5)
+            the_game().select_item(self.choice_inv)
+            the_game().throw_selected()
 
         self.floor.update_elements(self.monster_state)
 
     def change_hero_appearance(self, costume):
-        images = CG.get_hero_image(costume)
-        self.hero.graphicOutput = images[0]
-
+        self.hero.costume = costume
         images = CG.get_hero_image(costume)
 
         self.hero.graphicOutput = images[0]
-        self.hero.animationUDLR = {(0, -1): images[12:16],  # cannot put Coord since it's not hashable
+        self.hero.animationUDLR = {Coord(0, -1): images[12:16],
 
-                                   (0, 1): images[:4],
-                                   (-1, 1): images[:4],
-                                   (1, 1): images[:4],
+                                   Coord(0, 1): images[:4],
+                                   Coord(-1, 1): images[:4],
+                                   Coord(1, 1): images[:4],
 
-                                   (-1, 0): images[4:8],
-                                   (-1, -1): images[4:8],
+                                   Coord(-1, 0): images[4:8],
+                                   Coord(-1, -1): images[4:8],
 
-                                   (1, 0): images[8:12],
-                                   (1, -1): images[8:12],
+                                   Coord(1, 0): images[8:12],
+                                   Coord(1, -1): images[8:12],
 
                                    }
 
@@ -1870,31 +2409,40 @@ class GraphicVariables(object):
 
         return None
 
-    def draw_game_screen(self):
-        self.draw_map()
-        self.draw_elements(self.monster_state)
-        self.draw_hero_move()
+    def draw_game_screen(self, alpha=0.):
+        """Draws the map, the elements and the hero if one of them changed, see draw_hero_move for alpha.
+            Returns the changed rectangles."""
+        key = (self.floor, self.floor.version, self.monster_state, self.hero.state, tuple(self.hero.moving_UDLR),
+               self.attack_ticks)
+        if key == self._game_screen_key and not any(self.hero.moving_UDLR):
+            return []
+        self._game_screen_key = key
+
+        profiler = the_game().profiler
+        with profiler.phase("map"):
+            rects = self.draw_map()
+        with profiler.phase("elements"):
+            rects += self.draw_elements(self.monster_state)
+        with profiler.phase("hero"):
+            rects += self.draw_hero_move(alpha)
+        return rects
 
     def update_fog(self, actual_map):
-        for o in [actual_map.hero, Game.monsters[20][0]]:
-            if isinstance(o, Hero):
-                x = self.hero.x
-                y = self.hero.y
-            else:
-                c = actual_map.pos(o)
-                if c is None:
-                    break
-                x = c.x
-                y = c.y
-
-            radius = 5
+        """Removes the fog around the hero and the boss. Nothing is done if none of them changed cell,
+            or if the hero is not on the map."""
+        hero_pos = actual_map.pos(self.hero)
+        if hero_pos is None:
+            return
+        sources = [hero_pos, actual_map.pos(actual_map.boss)]
+        if sources == actual_map.fog_sources:
+            return
+        actual_map.fog_sources = sources
 
-            for i in range(-radius, radius + 1):
-                for j in range(-radius, radius + 1):
-                    c = Coord(x + i, y + j)
-                    if self.floor is not None and self.floor.in_graphic_map(c):
-                        if Coord(x, y).distance(c) <= radius:
-                            self.floor.graphic_map[y + j][x + i][1] = True
+        radius = 5
+        for c in sources:
+            if c is None:
+                break
+            actual_map.reveal_around(c.x, c.y, radius)
 
     def play_next_song(self):
         cle = 'Images/musiques/'
@@ -1903,51 +2451,169 @@ class GraphicVariables(object):
         pygame.mixer.music.play()
 
 
+class LazyTable(object):
+    """Class attribute built by a function on its first access, then stored in the class.
+        Used for the prototype tables of Game, so that importing the module loads no image.
+        The elements of the table get their proto_ref, see Game.prototype."""
+
+    def __init__(self, build):
+        self.build = build
+        self.__doc__ = build.__doc__
+
+    def __get__(self, instance, owner):
+        name = self.build.__name__
+        table = self.build()
+        for key, value in table.items():
+            if isinstance(value, Element):
+                value.proto_ref = (name, key, None)
+            elif isinstance(value, list):
+                for i, elem in enumerate(value):
+                    if isinstance(elem, Element):
+                        elem.proto_ref = (name, key, i)
+        setattr(owner, name, table)
+        return table
+
+
+class FrameProfiler(object):
+    """Times the phases of the frames of the main loop. The last `window` times of each phase give its percentiles,
+        shown by the overlay (F3). With dump_path (ROGUE_PROFILE) ending in .csv or .jsonl, the times of every
+        frame are also written in this file."""
+    phases = ("events", "monsters", "effects", "gui", "messages", "map", "elements", "hero", "total")
+    percentiles = (50, 95, 99)
+
+    def __init__(self, window=300, dump_path=None):
+        self.times = {name: deque(maxlen=window) for name in FrameProfiler.phases}
+        self.overlay_on = False
+        self.dump_path = dump_path
+
+        self._frame = {}
+        self._frame_start = None
+        self._frame_number = 0
+        self._dump = None
+        self._csv = None
+        self._font = None
+
+    @contextmanager
+    def phase(self, name):
+        """Adds the time spent in the with block to the phase name of the current frame."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._frame[name] = self._frame.get(name, 0.) + time.perf_counter() - start
+
+    def begin_frame(self):
+        self._frame_start = time.perf_counter()
+
+    def end_frame(self):
+        """Stores the times of the frame which ends, in ms, and writes them in the dump file."""
+        self._frame["total"] = time.perf_counter() - self._frame_start
+        row = {name: self._frame.get(name, 0.) * 1000 for name in FrameProfiler.phases}
+        for name, t in row.items():
+            self.times[name].append(t)
+        self._frame.clear()
+        self._frame_number += 1
+
+        if self.dump_path is not None:
+            self.dump(row)
+
+    def dump(self, row):
+        if self._dump is None:
+            self._dump = open(self.dump_path, "w", newline="")
+            if not self.dump_path.endswith(".jsonl"):
+                self._csv = csv.writer(self._dump)
+                self._csv.writerow(("frame",) + FrameProfiler.phases)
+
+        if self._csv is None:
+            self._dump.write(json.dumps(dict(frame=self._frame_number, **row)) + "\n")
+        else:
+            self._csv.writerow([self._frame_number] + [f"{t:.3f}" for t in row.values()])
+
+    def percentile(self, name, p):
+        values = sorted(self.times[name])
+        if not values:
+            return 0.
+        return values[min(len(values) - 1, len(values) * p // 100)]
+
+    def draw_overlay(self, screen, x, y):
+        """Draws the percentiles of each phase at (x, y), from the bottom. Returns the changed rectangle."""
+        if self._font is None:
+            self._font = pygame.font.SysFont('Consolas', 16)
+        rows = [["phase (ms)"] + [f"p{p}" for p in FrameProfiler.percentiles]]
+        for name in FrameProfiler.phases:
+            rows.append([name] + [f"{self.percentile(name, p):.2f}" for p in FrameProfiler.percentiles])
+
+        line_height = self._font.get_linesize()
+        first_width = max(self._font.size(row[0])[0] for row in rows) + 10
+        column_width = max(self._font.size(cell)[0] for row in rows for cell in row[1:]) + 10
+        rect = pygame.Rect(x, y - len(rows) * line_height - 10,
+                           first_width + column_width * len(FrameProfiler.percentiles) + 10, len(rows) * line_height + 10)
+        screen.fill((20, 20, 20), rect)
+        for i, row in enumerate(rows):
+            line_y = rect.y + 5 + i * line_height
+            screen.blit(self._font.render(row[0], True, (220, 220, 220)), (x + 5, line_y))
+            for j, cell in enumerate(row[1:]):
+                # Numbers are aligned on the right of their column
+                text = self._font.render(cell, True, (220, 220, 220))
+                screen.blit(text, (x + 5 + first_width + (j + 1) * column_width - text.get_width(), line_y))
+        return rect
+
+    def close(self):
+        if self._dump is not None:
+            self._dump.close()
+            self._dump = None
+            self._csv = None
+
+
 class Game(object):
     """ Class representing game state """
 
-    """ available equipments """
-    equipments = {0: [Equipment("gold", "o"),
-                      Equipment("basic bread", "§", usage=lambda self, hero: FeedEffect.activate(
-                          FeedEffect(hero, 1, hero.default_stomach_size))),
-                      Equipment("hunger mushroom", "£",
-                                usage=lambda self, hero: HungerEffect.activate(HungerEffect(hero, 3, 1))),
-                      Equipment("poisonous mushroom", "%", price=2,
-                                usage=lambda self, hero: PoisonEffect.activate(PoisonEffect(hero, 3, 1))),
-                      ],
-                  1: [Equipment("strength potion", "!", price=3,
-                                usage=lambda self, hero: StrengthEffect.activate(
-                                    StrengthEffect(hero, 10, 3))),
-                      Equipment("weakness potion", "!", price=3,
-                                usage=lambda self, hero: WeaknessEffect.activate(WeaknessEffect(hero, 10))),
-                      Equipment("teleport potion", "!", price=3,
-                                usage=lambda self, hero: TeleportEffect.activate(TeleportEffect(hero))),
-                      Equipment("healing potion", "!", price=3,
-                                usage=lambda self, hero: HealEffect.activate(HealEffect(hero, 1, 3))),
-                      ],
-                  2: [Equipment("milk", "m", price=4, usage=lambda self, hero: Effect.clear()),
-                      ],
-                  3: [Equipment("portoloin", "w", price=15,
-                                usage=lambda self, hero: TeleportEffect.activate(TeleportEffect(hero),
-                                                                                 False)),
-                      Equipment("healing potion", "!", price=5,
-                                usage=lambda self, hero: HealEffect.activate(HealEffect(hero, 1, 6))),
-                      Equipment("strength potion", "!", price=5,
-                                usage=lambda self, hero: StrengthEffect.activate(
-                                    StrengthEffect(hero, 10, 10))),
-                      ],
-                  }
-
-    """ available weapons """
-    weapons = {
-        0: [Weapon("Basic Sword", "†", price=2, damage=random.randint(2, 6), launching_damage=random.randint(1, 3))],
-        1: [Weapon("Shuriken", "*", damage=random.randint(1, 2), launching_damage=random.randint(3, 5))],
-        2: [Weapon("Boomerang", "¬", price=3, damage=random.randint(1, 2), launching_damage=random.randint(2, 3),
-                   come_back=True)],
-    }
-
-    """ available monsters """
-    monsters = {0: [Creature("Goblin", hp=4, xp=4),
+    @LazyTable
+    def equipments():
+        """ available equipments """
+        return {0: [Equipment("gold", "o"),
+                    Equipment("basic bread", "§", usage=lambda self, hero: FeedEffect.activate(
+                        FeedEffect(hero, 1, hero.default_stomach_size))),
+                    Equipment("hunger mushroom", "£",
+                              usage=lambda self, hero: HungerEffect.activate(HungerEffect(hero, 3, 1))),
+                    Equipment("poisonous mushroom", "%", price=2,
+                              usage=lambda self, hero: PoisonEffect.activate(PoisonEffect(hero, 3, 1))),
+                    ],
+                1: [Equipment("strength potion", "!", price=3,
+                              usage=lambda self, hero: StrengthEffect.activate(
+                                  StrengthEffect(hero, 10, 3))),
+                    Equipment("weakness potion", "!", price=3,
+                              usage=lambda self, hero: WeaknessEffect.activate(WeaknessEffect(hero, 10))),
+                    Equipment("teleport potion", "!", price=3,
+                              usage=lambda self, hero: TeleportEffect.activate(TeleportEffect(hero))),
+                    Equipment("healing potion", "!", price=3,
+                              usage=lambda self, hero: HealEffect.activate(HealEffect(hero, 1, 3))),
+                    ],
+                2: [Equipment("milk", "m", price=4, usage=lambda self, hero: Effect.clear()),
+                    ],
+                3: [Equipment("portoloin", "w", price=15,
+                              usage=lambda self, hero: TeleportEffect.activate(TeleportEffect(hero),
+                                                                               False)),
+                    Equipment("healing potion", "!", price=5,
+                              usage=lambda self, hero: HealEffect.activate(HealEffect(hero, 1, 6))),
+                    Equipment("strength potion", "!", price=5,
+                              usage=lambda self, hero: StrengthEffect.activate(
+                                  StrengthEffect(hero, 10, 10))),
+                    ],
+                }
+
+    @LazyTable
+    def weapons():
+        """ available weapons """
+        return {0: [Weapon("Basic Sword", "†", price=2, damage=(2, 6), launching_damage=(1, 3))],
+                1: [Weapon("Shuriken", "*", damage=(1, 2), launching_damage=(3, 5))],
+                2: [Weapon("Boomerang", "¬", price=3, damage=(1, 2), launching_damage=(2, 3), come_back=True)],
+                }
+
+    @LazyTable
+    def monsters():
+        """ available monsters """
+        return {0: [Creature("Goblin", hp=4, xp=4),
                     Creature("Bat", hp=2, abbreviation="W", xp=2),
                     Creature("BabyDemon", hp=2, strength=2, xp=4)],
                 1: [Creature("Ork", hp=4, strength=2, xp=10),
@@ -1975,126 +2641,526 @@ class Game(object):
 
                 }
 
-    _room_objects = {'upstair': RoomObject('upstair', "^", usage=lambda: RoomObject.go_upstair()),
-                     'downstair': RoomObject('downstair', "v", usage=lambda: RoomObject.go_downstair()),
-                     'marchand': RoomObject('marchand', "", usage=lambda: RoomObject.meet_trader()),
-                     }
+    @LazyTable
+    def _room_objects():
+        return {'upstair': RoomObject('upstair', "^", usage=lambda: RoomObject.go_upstair()),
+                'downstair': RoomObject('downstair', "v", usage=lambda: RoomObject.go_downstair()),
+                'marchand': RoomObject('marchand', "", usage=lambda: RoomObject.meet_trader()),
+                }
+
+    boss_ref = ('monsters', 20, 0)  # proto_ref of the boss of the last floor
 
-    _special_rooms_list = {"finalBoss": Room(Coord(1, 1), Coord(19, 10), [monsters[20][0]]),
-                           'marchand': Room(Coord(15, 15), Coord(19, 19), [_room_objects['marchand']]),
-                           }
+    @LazyTable
+    def _special_rooms_list():
+        return {"finalBoss": Room(Coord(1, 1), Coord(19, 10), [Game.prototype(Game.boss_ref)]),
+                'marchand': Room(Coord(15, 15), Coord(19, 19), [Game._room_objects['marchand']]),
+                }
 
     sizeFactor = Map.sizeFactor
+    MESSAGE_LOG_SIZE = 100  # The oldest lines are dropped when nothing reads them (headless games)
+    _way_keys = {way: key for key, way in Map.dir.items()}
 
-    def __init__(self, level=1, hero=None, nb_floors=4):
+    # Saves: a header (SAVE_MAGIC, SAVE_VERSION and the length of the json), the game state in json,
+    # then the terrain and fog arrays of the floors created, each one aligned on SAVE_ALIGNMENT bytes
+    SAVE_MAGIC = b"ROGUESAV"
+    SAVE_VERSION = 2
+    SAVE_ALIGNMENT = 16
+    save_path = "save.rog"
+
+    # Replays: a header line "rogue-replay REPLAY_VERSION seed nb_floors", then the tokens of the logical actions
+    # separated by spaces, see play_replay
+    REPLAY_VERSION = 1
+    replay_path = "last_run.replay"
+
+    _effect_classes = {cls.__name__: cls for cls in (HealEffect, PoisonEffect, FeedEffect, HungerEffect,
+                                                     TeleportEffect, StrengthEffect, WeaknessEffect)}
+
+    @staticmethod
+    def prototype(ref):
+        """Returns the element of the tables of Game of the given proto_ref."""
+        name, key, index = ref
+        prototype = getattr(Game, name)[key]
+        return prototype if index is None else prototype[index]
+
+    def __init__(self, level=1, hero=None, nb_floors=4, seed=None):
+
+        # Every random draw of the game comes from a stream of rng, derived from the seed
+        if seed is None:
+            seed = random.getrandbits(32)
+        self.seed = seed
+        self._rngs = {}
 
         self.level = level
-        self.active_effects = []
-        self._message = []
+        self.effects = EffectScheduler()
+        self._message = deque(maxlen=Game.MESSAGE_LOG_SIZE)  # Lines not read yet by the display
 
         if hero is None:
             hero = Hero()
         self.hero = hero
 
         self.nb_floors = nb_floors
-        self.floor_list = []
+        self.floor_list = []  # None for the floors not created yet
+        self._floor_jobs = []  # Arguments of generate_floor_layout for each floor
+        self._prefetched = {}  # Floor number -> future of its layout
+        self._executor = None
         self.actual_floor = 0
         self.floor = None
 
         self.number_of_round = 0
-        self.apply_effects_bool = False
 
         # GRAPHICS
         self.gv = GraphicVariables(self.hero)
 
         self.paused = False
 
-    def build_floor(self):
-        """Creates a map for the current floor."""
+        self.profiler = FrameProfiler(dump_path=os.environ.get("ROGUE_PROFILE"))
 
-        place_hero = True
-        rand = random.randint(0, self.nb_floors - 2)
+        self._replay = []  # Tokens of the logical actions played, None when not recording
+        self.replay_input = None  # Tokens left to play when playing a replay
 
+    def build_floor(self):
+        """Draws the seed of every floor and creates the first one.
+            The other floors are created when the hero first enters them, see get_floor."""
+        rng = self.rng('map')
+        rand = rng.randint(0, self.nb_floors - 2)
+        self._floor_jobs = []
         for i in range(self.nb_floors):
-            print('Building Floor ' + str(i + 1) + '/' + str(self.nb_floors))
-
+            special_room = None
             if i == rand:
-                self.floor_list.append(
-                    Map(hero=self.hero, put_hero=place_hero, floor_number=i, special_room='marchand'))
+                special_room = 'marchand'
             elif i == self.nb_floors - 1:
-                self.floor_list.append(
-                    Map(hero=self.hero, put_hero=place_hero, floor_number=i, special_room='finalBoss'))
+                special_room = 'finalBoss'
+            self._floor_jobs.append((i, self.nb_floors, special_room, i == 0, rng.getrandbits(32)))
+
+        self.floor_list = [None] * self.nb_floors
+        self.gv.floor = self.floor = self.get_floor(self.actual_floor)
+
+    def get_floor(self, n):
+        """Returns the map of the floor n, creating it if needed, and starts generating the next floor
+            in the background so that it is ready when the hero takes the stairs."""
+        if self.floor_list[n] is None:
+            layout = None
+            future = self._prefetched.pop(n, None)
+            if future is not None:
+                try:
+                    layout = future.result()
+                except BrokenProcessPool:
+                    print("Floor " + str(n + 1) + " could not be generated in the background")
+                    self._executor = None
+            if layout is None:
+                layout = generate_floor_layout(*self._floor_jobs[n])
+            print('Building Floor ' + str(n + 1) + '/' + str(self.nb_floors))
+            self.floor_list[n] = Map.from_layout(layout, self.hero, put_hero=n == 0)
+        self.prefetch_floor(n + 1)
+        return self.floor_list[n]
+
+    def prefetch_floor(self, n):
+        """Starts generating the floor n in a worker process, if it exists and was not yet.
+            Nothing is done in headless mode, where no frame waits for the floor."""
+        if CG.headless or n >= self.nb_floors or self.floor_list[n] is not None or n in self._prefetched:
+            return
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(max_workers=1, initializer=CG.set_headless,
+                                                 mp_context=multiprocessing.get_context("spawn"))
+        self._prefetched[n] = self._executor.submit(generate_floor_layout, *self._floor_jobs[n])
+
+    def close(self):
+        """Stops the background generation of the floors and closes the profiler dump, when the game ends."""
+        self.stop_prefetch()
+        self.profiler.close()
+
+    def stop_prefetch(self):
+        """Stops the background generation of the floors, whose layouts are dropped."""
+        if self._executor is not None:
+            self._executor.shutdown(cancel_futures=True)
+            self._executor = None
+            self._prefetched.clear()
+
+    def rng(self, name):
+        """Returns the random generator of a part of the game: 'map' draws the seeds of the floors,
+            'loot' the items and 'combat' the effects. Each one is seeded from the game seed and its name,
+            so that what one part draws does not change what the others do."""
+        if name not in self._rngs:
+            self._rngs[name] = random.Random(f"{self.seed}:{name}")
+        return self._rngs[name]
+
+    @staticmethod
+    def _plain_state(o, reference, skip=()):
+        """Returns the attributes of o holding plain values which differ from the ones of reference, if given."""
+        state = {}
+        for k, v in o.__dict__.items():
+            if k in skip or not isinstance(v, (bool, int, float, str, type(None))):
+                continue
+            if reference is None or k not in reference.__dict__ or reference.__dict__[k] != v:
+                state[k] = v
+        return state
+
+    def _element_state(self, o):
+        """Returns what is saved of an element: the hero is saved with the game, the other elements
+            by their prototype and what differs from it."""
+        if o is self.hero:
+            return "hero"
+        prototype = Game.prototype(o.proto_ref)
+        state = {"ref": o.proto_ref, "state": Game._plain_state(o, prototype)}
+        if o is prototype:
+            state["shared"] = True
+        if isinstance(o, Creature):
+            state["inventory"] = [self._element_state(x) for x in o._inventory]
+            state["weapon"] = [self._element_state(x) for x in o.weapon_slot]
+        return state
+
+    def _element_from_state(self, state):
+        """Returns the element saved by _element_state."""
+        if state == "hero":
+            return self.hero
+        prototype = Game.prototype(tuple(state["ref"]))
+        o = prototype if state.get("shared") else copy.copy(prototype)
+        o.__dict__.update(state["state"])
+        if isinstance(o, Creature):
+            o._inventory = [self._element_from_state(x) for x in state["inventory"]]
+            o.weapon_slot = [self._element_from_state(x) for x in state["weapon"]]
+        return o
+
+    def save(self, path=None):
+        """Saves the game in a file, Game.save_path by default."""
+        arrays = []
+
+        def layer(a):
+            arrays.append(np.ascontiguousarray(a))
+            return len(arrays) - 1
+
+        def rng_state(state):
+            version, key, gauss = state
+            return version, layer(np.array(key, dtype=np.uint32)), gauss
+
+        floors = []
+        for floor in self.floor_list:
+            if floor is None:
+                floors.append(None)
+                continue
+            state, terrain, explored = floor.save_state(self._element_state)
+            state["terrain"] = layer(terrain)
+            state["explored"] = layer(explored)
+            state["rng"] = rng_state(state["rng"])
+            floors.append(state)
+
+        effects = []
+        for effect in self.effects:
+            if effect.creature is self.hero:
+                creature = "hero"
+            else:
+                creature = None
+                for n, floor in enumerate(self.floor_list):
+                    if floor is not None and effect.creature in floor:
+                        c = floor.pos(effect.creature)
+                        creature = (n, c.x, c.y)
+                if creature is None:  # The creature is dead
+                    continue
+            effects.append({"class": type(effect).__name__, "creature": creature,
+                            "state": Game._plain_state(effect, None)})
+
+        hero = {"state": Game._plain_state(self.hero, Hero(), ("state",)),
+                "inventory": [self._element_state(x) for x in self.hero._inventory],
+                "weapon": [self._element_state(x) for x in self.hero.weapon_slot]}
+
+        rngs = {name: rng_state(rng.getstate()) for name, rng in self._rngs.items()}
+
+        layers = []
+        offset = 0
+        for a in arrays:
+            layers.append((offset, a.shape, a.dtype.str))
+            offset += -(-a.nbytes // Game.SAVE_ALIGNMENT) * Game.SAVE_ALIGNMENT
+
+        data = json.dumps({"seed": self.seed,
+                           "rngs": rngs,
+                           "level": self.level,
+                           "nb_floors": self.nb_floors,
+                           "actual_floor": self.actual_floor,
+                           "number_of_round": self.number_of_round,
+                           "messages": list(self._message),
+                           "floor_jobs": self._floor_jobs,
+                           "hero": hero,
+                           "floors": floors,
+                           "effects": effects,
+                           "effects_round": self.effects.round,
+                           "layers": layers}, separators=(",", ":")).encode()
+
+        # Written next to the file then renamed, as a loaded game may map the file
+        path = path or Game.save_path
+        with open(path + ".tmp", "wb") as f:
+            f.write(struct.pack("<8sII", Game.SAVE_MAGIC, Game.SAVE_VERSION, len(data)))
+            f.write(data)
+            f.write(bytes(-f.tell() % Game.SAVE_ALIGNMENT))
+            for a in arrays:
+                f.write(a.tobytes())
+                f.write(bytes(-a.nbytes % Game.SAVE_ALIGNMENT))
+
+        # The arrays of the floors loaded from a file get their own copy, which unmaps the file:
+        # a mapped file cannot be replaced on Windows
+        for floor in self.floor_list:
+            if floor is not None:
+                if isinstance(floor._terrain, np.memmap):
+                    floor._terrain = np.array(floor._terrain)
+                if isinstance(floor.explored, np.memmap):
+                    floor.explored = np.array(floor.explored)
+        os.replace(path + ".tmp", path)
+
+    def load(self, path=None):
+        """Replaces the state of the game by the one saved in a file, Game.save_path by default.
+            The terrain and fog arrays are memory mapped copy on write, the surfaces come from the image cache.
+            Raises ValueError, the game being unchanged, if the file is not a saved game of this version."""
+        path = path or Game.save_path
+        with open(path, "rb") as f:
+            header = f.read(16)
+            if len(header) < 16:
+                raise ValueError(path + " is not a saved game")
+            magic, version, length = struct.unpack("<8sII", header)
+            if magic != Game.SAVE_MAGIC:
+                raise ValueError(path + " is not a saved game")
+            if version != Game.SAVE_VERSION:
+                raise ValueError(f"Unsupported version {version} of saved game")
+            data = json.loads(f.read(length))
+            start = f.tell() + (-f.tell() % Game.SAVE_ALIGNMENT)
+
+        if data["layers"]:
+            blob = np.memmap(path, dtype=np.uint8, mode="c", offset=start)
+        layers = []
+        for offset, shape, dtype in data["layers"]:
+            dtype = np.dtype(dtype)
+            size = int(np.prod(shape)) * dtype.itemsize
+            layers.append(blob[offset:offset + size].view(dtype).reshape(shape))
+
+        def rng_state(state):
+            version, key, gauss = state
+            return version, layers[key].tolist(), gauss
+
+        self.stop_prefetch()
+        self.seed = data["seed"]
+        self._rngs = {name: random_from_state(rng_state(state)) for name, state in data["rngs"].items()}
+        self.level = data["level"]
+        self.nb_floors = data["nb_floors"]
+        self.actual_floor = data["actual_floor"]
+        self.number_of_round = data["number_of_round"]
+        self._message = deque(data["messages"], maxlen=Game.MESSAGE_LOG_SIZE)
+        self._floor_jobs = [tuple(job) for job in data["floor_jobs"]]
+
+        self.hero = Hero()
+        self.hero.__dict__.update(data["hero"]["state"])
+        self.hero._inventory = [self._element_from_state(x) for x in data["hero"]["inventory"]]
+        self.hero.weapon_slot = [self._element_from_state(x) for x in data["hero"]["weapon"]]
+        self.gv.hero = self.hero
+        self.gv.change_hero_appearance(self.hero.costume)
+
+        self.floor_list = []
+        for state in data["floors"]:
+            if state is None:
+                self.floor_list.append(None)
+                continue
+            state["rng"] = rng_state(state["rng"])
+            self.floor_list.append(Map.from_save(state, layers[state["terrain"]], layers[state["explored"]],
+                                                 self.hero, self._element_from_state))
+        self.floor = self.gv.floor = self.floor_list[self.actual_floor]
+
+        self.effects = EffectScheduler()
+        self.effects.round = data["effects_round"]
+        for saved in data["effects"]:
+            effect = Game._effect_classes[saved["class"]].__new__(Game._effect_classes[saved["class"]])
+            effect.__dict__.update(saved["state"])
+            effect.game = self
+            if saved["creature"] == "hero":
+                effect.creature = self.hero
             else:
-                self.floor_list.append(Map(hero=self.hero, put_hero=place_hero, floor_number=i))
-            place_hero = False
+                n, x, y = saved["creature"]
+                effect.creature = self.floor_list[n].get(Coord(x, y))
+            self.effects.add(effect)
 
-        self.gv.floor = self.floor = self.floor_list[self.actual_floor]
+        self.gv.invalidate()
+        self.prefetch_floor(self.actual_floor + 1)
 
     @staticmethod
     def rearrange_sentences(text_message, length_max=50):
-        text_message_list = text_message.split(" ")
-
+        """Cuts a message in lines of at most length_max characters, each word being followed by a space.
+            A word longer than a line is cut in pieces of length_max characters."""
         res = []
-        word_to_add = ""
-
-        while len(text_message_list) != 0:
-
-            if len(text_message_list[0]) > length_max:
-                res.append(text_message_list[0][:length_max])
-                word_to_recount = text_message_list[0][length_max + 1:]
-                text_message_list.pop(0)
-                word_to_add = word_to_recount + " " + word_to_add
-
-            if len(word_to_add + text_message_list[0]) <= length_max:
-                word_to_add += text_message_list.pop(0) + " "
-                if len(text_message_list) == 0:
-                    res.append(word_to_add)
-            else:
-                res.append(word_to_add)
-                word_to_add = ""
-
+        line = []
+        line_length = 0  # With the space after each word
+        for word in text_message.split(" "):
+            while len(word) > length_max:
+                if line:
+                    res.append(" ".join(line) + " ")
+                    line, line_length = [], 0
+                res.append(word[:length_max])
+                word = word[length_max:]
+
+            if line and line_length + len(word) > length_max:
+                res.append(" ".join(line) + " ")
+                line, line_length = [], 0
+            line.append(word)
+            line_length += len(word) + 1
+
+        if line:
+            res.append(" ".join(line) + " ")
         return res
 
     def add_message(self, msg):
         """Adds a message in the message list."""
 
-        line_list = Game.rearrange_sentences(msg)
-        for line_text in line_list:
-            self._message.append(line_text)
+        self._message.extend(Game.rearrange_sentences(msg))
+
+    def pop_messages(self):
+        """Returns the text of the pending messages and clears them."""
+        messages = list(self._message)
+        self._message.clear()
+        return messages
 
     def read_messages(self):
-        """Returns the message list and clears it."""
+        """Returns the rendered message list and clears it."""
         renders = []
-        for m in self._message:
-            renders.append(self.gv.game_font.render(m, True, (0, 0, 0)))
-
-        self._message.clear()
-        return renders.copy()
+        for m in self.pop_messages():
+            renders.append(CG.render_text(self.gv.game_font, m))
+        return renders
 
     @staticmethod
-    def rand_element(collect, floor_level):
+    def rand_element(collect, floor_level, rng):
         """Returns a clone of random element from a collection using exponential random law."""
-        x = random.expovariate(1 / (floor_level + 1))
+        x = rng.expovariate(1 / (floor_level + 1))
         for k in collect.keys():
             if k <= x:
                 element_list = collect[k]
-        return copy.copy(random.choice(element_list))
+        element = copy.copy(rng.choice(element_list))
+        if isinstance(element, Weapon):
+            element.roll(rng)
+        return element
 
     def rand_equipment(self, floor_level):
         """Returns a random equipment."""
-        return self.rand_element(Game.equipments, floor_level)
+        return self.rand_element(Game.equipments, floor_level, self.rng('loot'))
 
     def rand_monster(self, floor_level):
         """Returns a random monster."""
-        return self.rand_element(Game.monsters, floor_level)
+        return self.rand_element(Game.monsters, floor_level, self.rng('loot'))
+
+    def apply_effects(self):
+        """Plays a round of the active effects, see EffectScheduler."""
+        self.effects.tick()
+
+    def record(self, token):
+        """Adds a logical action to the replay of the game."""
+        if self._replay is not None:
+            self._replay.append(token)
+
+    def stop_recording(self):
+        """Stops the replay, which can not be played from the seed anymore (a saved game was loaded)."""
+        self._replay = None
+
+    def replay_text(self):
+        """Returns the replay of the game played so far."""
+        return f"rogue-replay {Game.REPLAY_VERSION} {self.seed} {self.nb_floors}\n" + " ".join(self._replay) + "\n"
+
+    def move_hero(self, way):
+        """Moves the hero in the direction way."""
+        self.record(Game._way_keys[way])
+        self.floor.move(self.hero, way)
+
+    def act(self, key):
+        """Makes the hero do an action of Game._actions."""
+        self.record(key)
+        Game._actions[key](self.hero)
+
+    def select_item(self, n):
+        """Selects the item n of the inventory, for the actions using it."""
+        self.record("i" + str(n))
+        self.gv.choice_inv = n
+
+    def throw_selected(self):
+        """Throws the item selected in the inventory."""
+        self.record("L")
+        self.hero.throw_item(self.gv.select_from_inventory(Equipment), 5)
+
+    def buy_from_trader(self, n):
+        """Buys the item of the line n of the trader menu."""
+        self.record("$" + str(n))
+        self.hero.buy(self.gv.list_menu[n][0])
+
+    def new_round(self):
+        """Resolves a round after the hero acted: monsters move, the hero digests and effects are applied."""
+        self.record(".")
+        self.number_of_round += 1
+        with self.profiler.phase("monsters"):
+            self.floor.move_all_monsters()
+
+        if self.number_of_round % 5 == 0 and self.hero.stomach == Hero.default_stomach_size:
+            self.hero.hp += 1
+            if self.hero.hp > self.hero.default_hp:
+                self.hero.hp -= 1
+
+        if self.number_of_round % 20 == 0 and self.hero.__dict__["stomach"] > 0:
+            self.hero.__dict__["stomach"] -= 1
+        self.hero.check_stomach()
+
+        with self.profiler.phase("effects"):
+            self.apply_effects()
+
+    def play_turn(self, way):
+        """Moves the hero in the direction way without any animation and resolves the round if the hero acted."""
+        elem_in_way = self.floor.check_move(self.hero, way)
+        self.move_hero(way)
+        if elem_in_way == Map.ground or isinstance(elem_in_way, Creature):
+            self.new_round()
+
+    @staticmethod
+    def play_replay(text):
+        """Plays again a replay without display nor delay, and returns the game. The tokens are:
+            z x d q a e w c: the hero moves in this direction of Map.dir    .: a round is played
+            k b n l u t: the hero does this action of Game._actions        L: the hero throws the selected item
+            i<n>: the item n of the inventory is selected                  /<way>: the direction of a throw
+            $<n>: the item of the line n of the trader menu is bought"""
+        header, _, body = text.partition("\n")
+        name, version, seed, nb_floors = header.split()
+        if name != "rogue-replay" or int(version) != Game.REPLAY_VERSION:
+            raise ValueError("Unsupported replay: " + header)
+
+        game = the_game(Game(seed=int(seed), nb_floors=int(nb_floors)))
+        game.build_floor()
+        game.replay_input = deque(body.split())
+        while game.replay_input:
+            token = game.replay_input.popleft()
+            if token in Map.dir:
+                game.move_hero(Map.dir[token])
+            elif token == ".":
+                game.new_round()
+            elif token in Game._actions:
+                game.act(token)
+            elif token == "L":
+                game.throw_selected()
+            elif token[0] == "i":
+                game.select_item(int(token[1:]))
+            elif token[0] == "$":
+                game.buy_from_trader(int(token[1:]))
+            else:
+                raise ValueError("Unknown replay token: " + token)
+            game.pop_messages()
+        game.replay_input = None
+        return game
+
+    def play_headless(self, ways):
+        """Plays the hero moves of ways without display, until they are exhausted or the hero dies.
+            Returns the number of rounds played."""
+        if not self.floor_list:
+            self.build_floor()
+
+        for way in ways:
+            if self.hero.hp <= 0:
+                break
+            self.play_turn(way)
+            self.pop_messages()
+        return self.number_of_round
 
     def play_with_graphics(self):
 
         print("\n--- Initialising Graphics ---")
         print("Loading ...")
 
-        self.build_floor()
-
         pygame.init()
 
         # Create the screen
@@ -2112,6 +3178,15 @@ class Game(object):
         icon = pygame.image.load("images/magicsword.png")
         pygame.display.set_icon(icon)
 
+        # Images, loaded once the display exists so that they are converted to its format. The frames of the hero
+        # were loaded with it, before the display, so they are loaded again.
+        CG.clear_cache()
+        self.gv.change_hero_appearance(self.hero.costume)
+        self.gv.load_surfaces()
+        CG.warm_up(Map)
+
+        self.build_floor()
+
         # Font
         self.gv.game_font = pygame.font.SysFont('Agencyfc', 30)
         self.gv.menu_font = pygame.font.SysFont('papyrus', 40)
@@ -2124,52 +3199,74 @@ class Game(object):
         # Initialize Brouillard
         self.gv.update_fog(self.floor)
 
+        clock = pygame.time.Clock()
+        lag = 0
+        menu_was_on = None
         while self.gv.running:
 
-            pygame.time.delay(50)
-
-            if self.gv.frame_count > 10:
-                self.gv.monster_state = opp(self.gv.monster_state)
-                self.gv.frame_count = 0
-            self.gv.frame_count += 1
+            lag = min(lag + clock.tick(GraphicVariables.FPS), GraphicVariables.MAX_LAG)
+            self.profiler.begin_frame()
 
             # Events
-            for event in pygame.event.get():
+            with self.profiler.phase("events"):
+                for event in pygame.event.get():
+
+                    if event.type == pygame.QUIT:
+                        self.gv.running = False
+
+                    elif event.type == song_end:
+                        self.gv.play_next_song()
 
-                if event.type == pygame.QUIT:
-                    self.gv.running = False
+                    elif event.type == pygame.KEYDOWN:
 
-                elif event.type == song_end:
-                    self.gv.play_next_song()
+                        if event.key == pygame.K_F3:
+                            self.profiler.overlay_on = not self.profiler.overlay_on
+                            self.gv.invalidate()
 
-                elif event.type == pygame.KEYDOWN:
+                        if event.key == pygame.K_ESCAPE:
+                            self.gv.menu_on = not self.gv.menu_on
+                            self.gv.list_menu = self.gv.options_menu
+                            self.gv.colour_menu = (140, 140, 150)
 
-                    if event.key == pygame.K_ESCAPE:
-                        self.gv.menu_on = not self.gv.menu_on
-                        self.gv.list_menu = self.gv.options_menu
-                        self.gv.colour_menu = (140, 140, 150)
+                            self.gv.inventory_on = False
 
-                        self.gv.inventory_on = False
+                        if self.gv.menu_on:
+                            self.gv.choose_in_menu(event)
 
-                    if self.gv.menu_on:
-                        self.gv.choose_in_menu(event)
+                        if event.key == pygame.K_i:
+                            self.gv.inventory_on = not self.gv.inventory_on
 
-                    if event.key == pygame.K_i:
-                        self.gv.inventory_on = not self.gv.inventory_on
+                        if self.gv.inventory_on:
+                            self.gv.choose_in_inventory(event)
 
-                    if self.gv.inventory_on:
-                        self.gv.choose_in_inventory(event)
+                    if not self.gv.inventory_on:
+                        self.gv.player_plays(event)
 
-                if not self.gv.inventory_on:
-                    self.gv.player_plays(event)
+            # Logic ticks
+            while lag >= GraphicVariables.TICK:
+                lag -= GraphicVariables.TICK
+                self.gv.update_monster_state()
+                if not self.gv.menu_on and self.hero.hp > 0:
+                    self.gv.msg_ticks += 1
+                    self.gv.update_hero_move()
+                    if self.gv.newRound:
+                        self.gv.newRound = False
+                        self.new_round()
+
+            # Only the rectangles changed by the draws are sent to the display
+            rects = []
+            if self.gv.menu_on != menu_was_on:
+                menu_was_on = self.gv.menu_on
+                self.gv.invalidate()
 
             # Menu
             if self.gv.menu_on:
-                self.gv.draw_menu(self.gv.list_menu, self.gv.colour_menu)
+                rects += self.gv.draw_menu(self.gv.list_menu, self.gv.colour_menu)
 
             else:
                 # Background
-                self.gv.draw_gui(self.gv.monster_state)
+                with self.profiler.phase("gui"):
+                    rects += self.gv.draw_gui(self.gv.monster_state)
 
                 if self.hero.hp <= 0:
                     # self.hero.hp = 1
@@ -2178,41 +3275,58 @@ class Game(object):
 
                 self.hero.check_inventory_size()
 
-                if self.gv.newRound:
-                    self.gv.newRound = False
-                    self.number_of_round += 1
-                    self.apply_effects_bool = True
-                    self.floor.move_all_monsters()
-
-                    if self.number_of_round % 5 == 0 and self.hero.stomach == Hero.default_stomach_size:
-                        self.hero.hp += 1
-                        if self.hero.hp > self.hero.default_hp:
-                            self.hero.hp -= 1
-
-                    if self.number_of_round % 20 == 0 and self.hero.__dict__["stomach"] > 0:
-                        self.hero.__dict__["stomach"] -= 1
-                    self.hero.check_stomach()
-
-                if self.apply_effects_bool:
-                    if len(self.active_effects) != 0:
-                        i = 0
-                        while i < len(self.active_effects):
-                            if not self.active_effects[i].update():
-                                i += 1
-                    self.apply_effects_bool = False
-
                 # Messages
-                self.gv.draw_message(200)
+                with self.profiler.phase("messages"):
+                    rects += self.gv.draw_message(200)
 
-                self.gv.draw_game_screen()
+                rects += self.gv.draw_game_screen(lag / GraphicVariables.TICK)
 
-            pygame.display.update()
+            if self.profiler.overlay_on:
+                rects.append(self.profiler.draw_overlay(self.gv.screen, 5, self.gv.height - 5))
+            pygame.display.update(rects)
+            self.profiler.end_frame()
 
+        if self._replay is not None:
+            with open(Game.replay_path, "w") as f:
+                f.write(self.replay_text())
+        self.close()
         pygame.quit()
 
 
-def the_game(game=Game()):
-    return game
+def random_from_state(state):
+    """Returns a random generator in the state given by Random.getstate, possibly with lists for tuples."""
+    rng = random.Random()
+    rng.setstate((state[0], tuple(state[1]), state[2]))
+    return rng
+
+
+def generate_floor_layout(floor_number, nb_floors, special_room, put_hero, seed):
+    """Generates a floor from the seed and returns its layout, see Map.layout."""
+    floor = Map(put_hero=put_hero, floor_number=floor_number, special_room=special_room, nb_floors=nb_floors,
+                rng=random.Random(seed))
+    return floor.layout()
+
+
+_game = None
+
+
+def the_game(game=None):
+    """Returns the current game, creating it if needed. A given game becomes the current one."""
+    global _game
+    if game is not None:
+        _game = game
+    elif _game is None:
+        _game = Game()
+    return _game
 
 
-the_game().play_with_graphics()
+if __name__ == '__main__':
+    if len(sys.argv) == 3 and sys.argv[1] == "--replay":
+        CG.set_headless()
+        with open(sys.argv[2]) as f:
+            replay = f.read()
+        start = time.perf_counter()
+        replayed = Game.play_replay(replay)
+        print(f"{replayed.number_of_round} rounds replayed in {time.perf_counter() - start:.3f} s")
+    else:
+        the_game().play_with_graphics()